@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""micro-benchmark: memoised force_categorical vs. regex-based implementation
+
+PYTHONPATH=. python3 benchmarks/bench_force_categorical.py [path.vrt.gz] [level] [attribute ...]
+
+values are all attributes of {level} regions in file order (as in
+vrt-cqpweb); the LRU cache of force_categorical is cleared before every
+repetition
+"""
+
+import re
+import string
+import sys
+import unicodedata
+from timeit import repeat
+
+from vrt.stream import S_OPEN, iter_path
+from vrt.vrt import force_categorical, meta2dict
+
+
+def force_categorical_regex(text, fallback="NA"):
+    whitelist = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_0123456789')
+    for a, b in [("ä", "ae"), ("Ä", "AE"), ("ö", "oe"), ("Ö", "OE"), ("ü", "ue"), ("Ü", "UE"), ("ß", "ss"),
+                 (" ", "_"), ("/", "_"), ("-", "_"), (r"\|", "_")]:
+        text = re.sub(a, b, text)
+    text = ''.join(x for x in unicodedata.normalize('NFKD', text) if x in string.printable).lower()
+    handle = ''.join(filter(whitelist.__contains__, text))
+    handle = fallback if handle == "" else handle
+    if not re.search("^[A-Za-z]", handle):
+        handle = "c_" + handle
+    return handle
+
+
+def collect_values(path, level, attributes):
+    values = list()
+    for kind, name, line in iter_path(path):
+        if kind == S_OPEN and name == level:
+            meta = meta2dict(line.decode(), level=level)
+            values.extend(v for k, v in meta.items() if not attributes or k in attributes)
+    return values
+
+
+def bench(func, values, number=5):
+    def run():
+        for value in values:
+            func(value)
+    return min(repeat(run, setup=force_categorical.cache_clear, number=1, repeat=number))
+
+
+if __name__ == '__main__':
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "tests/data/tagesschau-mini.vrt.gz"
+    level = sys.argv[2] if len(sys.argv) > 2 else "article"
+    attributes = sys.argv[3:]
+
+    values = collect_values(path, level, attributes)
+    assert all(force_categorical(v) == force_categorical_regex(v) for v in values)
+
+    t_regex = bench(force_categorical_regex, values)
+    t_memo = bench(force_categorical, values)
+    print(f"<{level}>: {len(values)} values, {len(set(values))} types, "
+          f"regex {t_regex / len(values) * 1e6:.2f} µs/value, "
+          f"memoised {t_memo / len(values) * 1e6:.2f} µs/value, "
+          f"speedup {t_regex / t_memo:.1f}x, {force_categorical.cache_info()}")
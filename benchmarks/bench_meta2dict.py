@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""micro-benchmark: meta2dict vs. ElementTree-based implementation
+
+PYTHONPATH=. python3 benchmarks/bench_meta2dict.py [path.vrt.gz] [level ...]
+
+the LRU cache of meta2dict is cleared before every repetition, so
+only lines repeated within one file (e.g. <s>) profit from it
+"""
+
+import sys
+from timeit import repeat
+
+from vrt.stream import S_OPEN, iter_path
+from vrt.vrt import _meta2dict_etree, _parse_s_att_line, meta2dict
+
+
+def collect_lines(path, level):
+    return [line.decode() for kind, name, line in iter_path(path) if kind == S_OPEN and name == level]
+
+
+def bench(func, lines, level, number=5):
+    def run():
+        for line in lines:
+            func(line, level)
+    return min(repeat(run, setup=_parse_s_att_line.cache_clear, number=1, repeat=number))
+
+
+if __name__ == '__main__':
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "tests/data/tagesschau-mini.vrt.gz"
+    levels = sys.argv[2:] if len(sys.argv) > 2 else ["article", "p", "s"]
+
+    for level in levels:
+        lines = collect_lines(path, level)
+        if len(lines) == 0:
+            continue
+        assert all(meta2dict(line, level) == _meta2dict_etree(line, level) for line in lines)
+        t_etree = bench(_meta2dict_etree, lines, level)
+        t_fast = bench(meta2dict, lines, level)
+        print(f"<{level}>: {len(lines)} lines, "
+              f"ElementTree {t_etree / len(lines) * 1e6:.2f} µs/line, "
+              f"meta2dict {t_fast / len(lines) * 1e6:.2f} µs/line, "
+              f"speedup {t_etree / t_fast:.1f}x")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""micro-benchmark: batched normalise_tokens vs. per-token normalisation
+
+PYTHONPATH=. python3 benchmarks/bench_normalise.py [path.vrt.gz] [level]
+
+the per-token path is the previous implementation (regexes compiled on
+every call, unicodedata.category per character)
+"""
+
+import re
+import sys
+from timeit import repeat
+from unicodedata import category
+
+from vrt.deduplicate import iter_regions, normalise_tokens
+from vrt.stream import iter_path
+
+
+def text_normalise_per_token(text):
+    text = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+').sub("", text)
+    text = re.compile(r'@\w+').sub("", text)
+    text = re.compile(r'^RT$').sub("", text)
+    text = ''.join([c for c in text if category(c).startswith('L')])
+    return text.lower()
+
+
+def collect_regions(path, level):
+    return [region for start, region in iter_regions(iter_path(path), level, normalise=False)]
+
+
+def bench(func, regions, number=5):
+    def run():
+        for region in regions:
+            func(region)
+    return min(repeat(run, number=1, repeat=number))
+
+
+if __name__ == '__main__':
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "tests/data/tweet-duplicates.vrt.gz"
+    level = sys.argv[2] if len(sys.argv) > 2 else "tweet"
+
+    regions = collect_regions(path, level)
+    nr_tokens = sum(len(region) for region in regions)
+    assert all(normalise_tokens(region) == [text_normalise_per_token(t) for t in region] for region in regions)
+
+    t_token = bench(lambda region: [text_normalise_per_token(t) for t in region], regions)
+    t_batch = bench(normalise_tokens, regions)
+    print(f"<{level}>: {len(regions)} regions, {nr_tokens} tokens, "
+          f"per token {t_token / nr_tokens * 1e6:.2f} µs/token, "
+          f"batched {t_batch / nr_tokens * 1e6:.2f} µs/token, "
+          f"speedup {t_token / t_batch:.1f}x")
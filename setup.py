@@ -42,6 +42,9 @@ setup(
         "pandas>=2.0",
         "tqdm>=4.67.1",
     ],
+    extras_require={
+        "parquet": ["pyarrow"],
+    },
     classifiers=[
         "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",
         "Development Status :: 3 - Alpha",
@@ -0,0 +1,75 @@
+import gzip
+import os
+
+from vrt.bgzf import build_index, is_bgzf_file, load_index, open_bgzf, read_index
+from vrt.stream import open_vrt
+
+
+def test_bgzf_roundtrip(tmp_path):
+
+    data = gzip.open("tests/data/tagesschau-mini.vrt.gz").read()
+    path = str(tmp_path / "test.vrt.gz")
+
+    with open_bgzf(path, "wb", threads=2) as f:
+        f.write(data)
+
+    assert is_bgzf_file(path)
+    assert not is_bgzf_file("tests/data/tagesschau-mini.vrt.gz")
+
+    # readable by plain gzip and by multi-threaded reader
+    assert gzip.open(path).read() == data
+    with open_vrt(path, threads=2) as f:
+        assert f.read() == data
+
+    # block index
+    assert read_index(path + ".gzi") == build_index(path)
+
+
+def test_bgzf_seek(tmp_path):
+
+    data = gzip.open("tests/data/tagesschau-mini.vrt.gz").read()
+    path = str(tmp_path / "test.vrt.gz")
+    with open_vrt(path, "wb", bgzf=True) as f:
+        f.write(data)
+
+    with open_bgzf(path) as f:
+        for offset in [0, 1, 65279, 65280, 300000, len(data) - 10]:
+            f.seek(offset)
+            assert f.tell() == offset
+            assert f.read(10) == data[offset: offset + 10]
+
+
+def test_bgzf_stale_index(tmp_path):
+
+    data = gzip.open("tests/data/tagesschau-mini.vrt.gz").read()
+    path = str(tmp_path / "test.vrt.gz")
+    with open_vrt(path, "wb", bgzf=True) as f:
+        f.write(data)
+
+    # rewritten (e.g. by another tool) without updating the index
+    new = data[: len(data) // 3].replace(b"\t", b"\t\t")
+    with open_bgzf(path, "wb", level=1, index=False) as f:
+        f.write(new)
+    os.utime(path + ".gzi", (0, 0))
+    with open_bgzf(path) as f:
+        f.seek(len(new) - 100)
+        assert f.read(100) == new[-100:]
+
+    # newer, but not pointing at blocks of the file
+    with open_vrt(path + "-other", "wb", bgzf=True) as f:
+        f.write(data)
+    os.replace(path + "-other.gzi", path + ".gzi")
+    assert load_index(path) == build_index(path)
+
+    load_index(path, write=True)
+    assert read_index(path + ".gzi") == build_index(path)
+
+
+def test_bgzf_text(tmp_path):
+
+    path = str(tmp_path / "test.vrt.gz")
+    with open_bgzf(path, "wt") as f:
+        f.write("<text>\nTäst\n</text>\n")
+
+    with open_bgzf(path, "rt") as f:
+        assert f.readlines() == ["<text>\n", "Täst\n", "</text>\n"]
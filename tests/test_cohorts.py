@@ -0,0 +1,49 @@
+import gzip
+import struct
+
+from vrt.bgzf import is_bgzf_file, open_bgzf
+from vrt.cohorts import cohort_via_sort, merge_runs, process_paths
+
+
+def test_strategies(tmp_path):
+
+    outputs = list()
+    for nr, strategy in enumerate([dict(memory=True), dict(), dict(sort=True), dict(sort=True, run_size=5000), dict(jobs=2), dict(jobs=2, bgzf=True)]):
+        path_out = str(tmp_path / f"cohorts-{nr}.vrt.gz")
+        process_paths(["tests/data/tagesschau-mini.vrt.gz"], path_out, False, 'article', 'article', 'cohort',
+                      ['month', 'rubrik'], **strategy)
+        outputs.append(gzip.open(path_out).read())
+
+    assert outputs[0].count(b"<cohort ") == 14
+    assert all(output == outputs[0] for output in outputs)
+
+    # BGZF output of parallel assembly can be seeked
+    path_out = str(tmp_path / f"cohorts-{nr}.vrt.gz")
+    assert is_bgzf_file(path_out)
+    with open_bgzf(path_out) as f:
+        f.seek(100000)
+        assert f.read(100) == outputs[0][100000: 100100]
+
+
+def test_merge_runs(tmp_path):
+
+    path_memory = str(tmp_path / "memory.vrt.gz")
+    process_paths(["tests/data/tagesschau-mini.vrt.gz"], path_memory, False, 'article', 'article', 'cohort',
+                  ['month', 'rubrik'], memory=True)
+
+    # many small runs, merged in several passes with at most 3 open runs
+    path_out = str(tmp_path / "sort.vrt.gz")
+    cohort_via_sort(["tests/data/tagesschau-mini.vrt.gz"], path_out, 'article', 'article', 'cohort',
+                    ['month', 'rubrik'], run_size=2000, fan_in=3)
+    assert gzip.open(path_out).read() == gzip.open(path_memory).read()
+
+    # intermediate runs are removed
+    records = [((nr % 5, nr), str(nr).encode()) for nr in range(40)]
+    paths = list()
+    for nr in range(0, 40, 4):
+        paths.append(str(tmp_path / f"run-{nr:05d}.bin.gz"))
+        with gzip.open(paths[-1], "wb") as f:
+            for (cohort_nr, seq), region in sorted(records[nr: nr + 4]):
+                f.write(struct.pack(">IQI", cohort_nr, seq, len(region)) + region)
+    assert list(merge_runs(paths, fan_in=3)) == sorted(records)
+    assert sorted(p.name for p in tmp_path.glob("*.bin.gz")) == sorted(p.split("/")[-1] for p in paths)
@@ -1,4 +1,9 @@
-from vrt.cqpweb import process_path
+import gzip
+from io import BytesIO
+
+from vrt.bgzf import is_bgzf_file
+from vrt.cqpweb import convert, process_path
+from vrt.stream import iter_path
 
 
 def test_process_path():
@@ -10,3 +15,51 @@ def test_process_path():
         'fname',
         ['year', 'month', 'rubrik']
     )
+
+
+def test_threads(tmp_path):
+
+    args = ("tests/data/tagesschau-mini.vrt.gz", True, 'article', 'fname', ['year', 'month', 'rubrik'])
+    process_path(args[0], str(tmp_path / "serial.vrt.gz"), *args[1:])
+    process_path(args[0], str(tmp_path / "threads.vrt.gz"), *args[1:], threads=2)
+    assert is_bgzf_file(str(tmp_path / "threads.vrt.gz"))
+    assert gzip.open(tmp_path / "serial.vrt.gz").read() == gzip.open(tmp_path / "threads.vrt.gz").read()
+
+
+def test_batches():
+
+    events = list(iter_path("tests/data/tagesschau-mini.vrt.gz"))
+    outputs = list()
+    for batch_size in [1, 100, 1 << 22]:
+        f_out = BytesIO()
+        *_, stats = convert(events, f_out, 'article', 'fname', ['year'], batch_size=batch_size)
+        outputs.append(f_out.getvalue())
+        assert stats['bytes'] == len(outputs[-1])
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert stats['tokens'] == sum(1 for line in outputs[0].split(b"\n") if line and not line.startswith(b"<"))
+
+
+def test_stdout(tmp_path, capsysbinary):
+
+    args = (True, 'article', 'fname', ['year', 'month', 'rubrik'])
+    path_in = str(tmp_path / "plain.vrt")
+    with open(path_in, "wb") as f:
+        f.write(gzip.open("tests/data/tagesschau-mini.vrt.gz").read())
+    process_path(path_in, str(tmp_path / "serial.vrt.gz"), *args)
+    expected = gzip.open(tmp_path / "serial.vrt.gz").read()
+    capsysbinary.readouterr()
+
+    for shards in [1, 2]:
+        process_path(path_in, "-", *args, shards=shards)
+        captured = capsysbinary.readouterr()
+        assert captured.out == expected
+        assert b"types" in captured.err
+
+    # plain gzip cannot be sharded: the warning must not end up in the output
+    path_gz = str(tmp_path / "plain.vrt.gz")
+    with gzip.open(path_gz, "wb") as f:
+        f.write(open(path_in, "rb").read())
+    process_path(path_gz, "-", *args, shards=2)
+    captured = capsysbinary.readouterr()
+    assert captured.out == expected
+    assert b"not seekable" in captured.err
@@ -1,5 +1,18 @@
-from vrt.deduplicate import fingerprint
+import gzip
+import os
+from argparse import Namespace
 from pprint import pprint
+from itertools import permutations
+from shutil import copyfile
+
+import pytest
+from numpy import array, uint32
+from pandas import read_csv
+
+from vrt.deduplicate import (detect, detect_near, fingerprint, main, merge_runs, normalise_tokens,
+                             signatures, text_normalise, write_runs)
+from vrt.minhash import clusters
+from vrt.store import FingerprintStore
 
 
 def test_process_path():
@@ -8,3 +21,160 @@ def test_process_path():
         "tests/data/tweet-duplicates.vrt.gz",
         level="tweet"
     ))
+
+
+def test_external(tmp_path):
+
+    # two copies: every region is duplicated across files
+    for p in ["tweets-1.vrt.gz", "tweets-2.vrt.gz"]:
+        copyfile("tests/data/tweet-duplicates.vrt.gz", tmp_path / p)
+
+    for keep in ['first', 'last']:
+        for jobs in [1, 2]:
+            dfs = list()
+            for external in [False, True]:
+                path_out = str(tmp_path / f"dup-{keep}-{jobs}-{external}.tsv.gz")
+                main(Namespace(glob_in=str(tmp_path / "tweets-*.vrt.gz"), path_out=path_out, force=False, level="tweet",
+                               keep=keep, normalise=True, shards=1, jobs=jobs, external=external, run_size=3, tmp_dir=None,
+                               near=None, store=None, filter=False))
+                dfs.append(read_csv(path_out, sep="\t", dtype=str))
+            memory, external = dfs
+            assert external.equals(memory.drop(columns=['id']))
+            assert (external['duplicate'] == "False").sum() == 1
+
+
+def test_merge_runs(tmp_path):
+
+    records = [bytes([(nr * 37) % 251, nr % 7]) for nr in range(100)]
+    paths = write_runs(records, str(tmp_path), run_size=5)
+    assert len(paths) == 20
+    # several passes with at most 3 open runs
+    assert list(merge_runs(paths, 2, fan_in=3)) == sorted(records)
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(p.split("/")[-1] for p in paths)
+
+
+def test_near(tmp_path):
+
+    words = "the quick brown fox jumps over the lazy dog and runs away into the dark forest".split()
+    regions = [words, words + ["again"], words[::-1], words[:-1]]
+    path = str(tmp_path / "near.vrt")
+    with open(path, "wt") as f:
+        for nr, tokens in enumerate(regions):
+            f.write(f'<tweet id="{nr}">\n' + "\n".join(tokens) + "\n</tweet>\n")
+
+    records, sigs = signatures(path, level="tweet")
+    assert sigs.shape == (4, 128)
+    ndup = detect_near(records, sigs, threshold=0.7, keep='first')
+    assert ndup['duplicate'].tolist() == [False, True, False, True]
+    assert ndup['nr_regions'].tolist() == [3, 3, 1, 3]
+    assert ndup['jaccard'].iloc[2] == 1.0
+    assert 0.7 <= ndup['jaccard'].iloc[1] < 1.0
+
+    # exact fingerprints miss them
+    assert detect(fingerprint(path, level="tweet"))['duplicate'].sum() == 0
+
+
+def test_clusters_bucket():
+
+    # one LSH bucket (second band): A and C are similar, B is similar to neither;
+    # B lies between A and C when the bucket is sorted
+    a, b, c = [1, 2, 5, 5], [4, 5, 5, 5], [1, 3, 5, 5]
+    for order in permutations(range(3)):
+        sigs = array([[a, b, c][i] for i in order], dtype=uint32)
+        labels = clusters(sigs, threshold=0.7, bands=2, rows=2)
+        pos = {i: order.index(i) for i in range(3)}
+        assert labels[pos[0]] == labels[pos[2]] != labels[pos[1]]
+
+
+def test_store(tmp_path):
+
+    path_store = str(tmp_path / "fingerprints.sqlite")
+    copyfile("tests/data/tweet-duplicates.vrt.gz", tmp_path / "day-1.vrt.gz")
+
+    def run(nr):
+        path_out = str(tmp_path / f"dup-{nr}.tsv.gz")
+        main(Namespace(glob_in=str(tmp_path / "day-*.vrt.gz"), path_out=path_out, force=False, level="tweet",
+                       keep="first", normalise=True, shards=1, jobs=1, external=False, near=None, store=path_store, filter=False))
+        return read_csv(path_out, sep="\t", dtype=str)
+
+    first = run(1)
+    assert (first['duplicate'] == "False").sum() == 1
+
+    # next day: old file is skipped, all new regions are duplicates of the first one
+    copyfile("tests/data/tweet-duplicates.vrt.gz", tmp_path / "day-2.vrt.gz")
+    second = run(2)
+    assert len(second) == 6
+    assert (second['duplicate'] == "True").all()
+    assert (second['cluster_id'] == first['cluster_id']).all()
+    assert (second['nr_regions'] == "12").all()
+
+    with FingerprintStore(path_store) as store:
+        assert len(store) == 1
+        assert store.status(str(tmp_path / "day-2.vrt.gz")) == "known"
+
+    # changed file: its old fingerprints are replaced, not counted twice
+    path_day_1 = str(tmp_path / "day-1.vrt.gz")
+    os.utime(path_day_1, (os.stat(path_day_1).st_atime, os.stat(path_day_1).st_mtime + 10))
+    third = run(3)
+    assert len(third) == 6
+    assert (third['nr_regions'] == "12").all()
+    with FingerprintStore(path_store) as store:
+        assert store.con.execute("SELECT nr_regions FROM clusters").fetchall() == [(12,)]
+        assert store.status(path_day_1) == "known"
+
+
+def test_normalise_tokens():
+
+    tokens = ["RT", "@user:", "Hallo", "ΟΔΟΣ", "https://t.co/xyz", "RTs", "x1y", "", "İstanbul", "…"]
+    assert normalise_tokens(tokens) == [text_normalise(t) for t in tokens]
+    assert normalise_tokens(tokens)[:4] == ["", "", "hallo", "οδος"]
+
+
+def test_filter(tmp_path):
+
+    for p in ["tweets-1.vrt.gz", "tweets-2.vrt.gz"]:
+        copyfile("tests/data/tweet-duplicates.vrt.gz", tmp_path / p)
+
+    lines = gzip.open("tests/data/tweet-duplicates.vrt.gz").read().split(b"\n")
+    for keep in ['first', 'last']:
+        path_out = str(tmp_path / f"dup-{keep}.tsv.gz")
+        main(Namespace(glob_in=str(tmp_path / "tweets-*.vrt.gz"), path_out=path_out, force=True, level="tweet", keep=keep,
+                       normalise=True, shards=1, jobs=1, external=False, near=None, store=None, filter=True))
+        kept = read_csv(path_out, sep="\t", dtype=str).query("duplicate == 'False'")
+        for p in ["tweets-1", "tweets-2"]:
+            ids = [line.split(b'"')[1].decode() for line in gzip.open(tmp_path / f"{p}.dedup.vrt.gz").read().split(b"\n")
+                   if line.startswith(b"<tweet ")]
+            assert ids == kept.loc[kept['path'].str.endswith(p + ".vrt.gz"), 'id'].tolist()
+
+    # all lines of the kept region are written
+    output = gzip.open(tmp_path / "tweets-2.dedup.vrt.gz").read().split(b"\n")
+    start = lines.index(output[0])
+    assert output[:-1] == lines[start: start + len(output) - 1]
+
+
+def test_filter_rerun(tmp_path):
+
+    for p in ["tweets-1.vrt.gz", "tweets-2.vrt.gz"]:
+        copyfile("tests/data/tweet-duplicates.vrt.gz", tmp_path / p)
+    data = gzip.open("tests/data/tweet-duplicates.vrt.gz").read()
+
+    args = dict(path_out=str(tmp_path / "dup.tsv.gz"), force=True, level="tweet", keep="first", normalise=True,
+                shards=1, jobs=1, external=False, near=None, store=None, filter=True)
+    outputs = list()
+    for _ in range(2):
+        # deduplicated files of the first run are not read again
+        main(Namespace(glob_in=str(tmp_path / "tweets-*.vrt.gz"), **args))
+        assert len(read_csv(args['path_out'], sep="\t")) == 2 * data.count(b"<tweet ")
+        outputs.append([gzip.open(tmp_path / f"tweets-{nr}.dedup.vrt.gz").read() for nr in [1, 2]])
+    assert outputs[0] == outputs[1]
+    assert gzip.open(tmp_path / "tweets-1.vrt.gz").read() == data
+
+    # same name without .vrt(.gz): same output
+    copyfile("tests/data/tweet-duplicates.vrt.gz", tmp_path / "tweets-1.vrt")
+    with pytest.raises(ValueError):
+        main(Namespace(glob_in=str(tmp_path / "tweets-*"), **args))
+
+    # output table is an input
+    with pytest.raises(ValueError):
+        main(Namespace(glob_in=str(tmp_path / "tweets-*.vrt.gz"), **{**args, 'path_out': str(tmp_path / "tweets-1.vrt.gz")}))
+    assert gzip.open(tmp_path / "tweets-1.vrt.gz").read() == data
@@ -1,4 +1,16 @@
-from vrt.indexing import process_path
+import gzip
+import io
+import os
+import re
+import time
+
+import pytest
+
+from vrt.indexing import guess_attributes, process_path, scan_schema
+from vrt.offsets import RegionIndex
+from vrt.offsets import process_path as process_offsets
+from vrt.shard import find_shards, write_parts
+from vrt.stream import iter_events, open_vrt
 
 
 def test_process_path():
@@ -14,3 +26,169 @@ def test_process_path():
         "/usr/local/share/cwb/registry/",
         True
     )
+
+
+def test_offsets(tmp_path):
+
+    data = gzip.open("tests/data/tagesschau-mini.vrt.gz").read()
+    path_in = str(tmp_path / "tagesschau-mini.vrt.gz")
+    with open_vrt(path_in, "wb", bgzf=True) as f:
+        f.write(data)
+
+    process_offsets(path_in, None, False, 'article', 'fname')
+
+    with RegionIndex(path_in, 'article') as index:
+        assert len(index) == 169
+        region = index.region(3)
+        assert region['id'] == 'kurzarbeit134'
+        assert region['cpos_start'] == 279
+        assert index.fetch(3) == data[region['start']: region['end']]
+        assert index.fetch_id('kurzarbeit134').startswith(b'<article ')
+        assert index.fetch(168).endswith(b'</article>\n')
+
+    # regenerated input: the old index is rejected, sharding scans the file instead
+    with open_vrt(path_in, "wb", bgzf=True) as f:
+        f.write(data.replace(b"<article ", b'<article x="1" '))
+    with pytest.raises(ValueError):
+        RegionIndex(path_in, 'article')
+    shards = find_shards(path_in, 'article', 3)
+    assert all(gzip.open(path_in).read()[start: start + 9] == b"<article " for start, end, nr in shards[1:])
+
+
+def test_guess_attributes_sample(tmp_path):
+
+    # attribute only present in the second half
+    data = gzip.open("tests/data/tagesschau-mini.vrt.gz").read()
+    start = data.index(b"<article ", len(data) // 2)
+    data = data[:start] + data[start:].replace(b"<article ", b'<article late="1" ')
+    path_in = str(tmp_path / "late.vrt.gz")
+    with open_vrt(path_in, "wb", bgzf=True) as f:
+        f.write(data)
+
+    first = guess_attributes(path_in, 1000)
+    full = guess_attributes(path_in, 0)
+    sampled = guess_attributes(path_in, 0, sample=8, sample_size=1 << 14, jobs=2)
+    assert os.path.exists(path_in + ".gzi")
+
+    assert 'article:0+date+fname+month+rubrik+year' in first['s_atts']
+    assert sampled['s_atts'] == full['s_atts']
+    assert 'article:0+date+fname+late+month+rubrik+year' in full['s_atts']
+    assert sampled['nr_p_atts'] == full['nr_p_atts'] == 2
+    assert sampled['stats']['nr_bytes'] <= 8 * (1 << 14) < full['stats']['nr_bytes'] == len(data)
+    assert full['stats']['nr_p_lines'] == sum(1 for line in data.split(b"\n")[:-1] if not line.startswith(b"<"))
+
+    # plain gzip cannot be sampled: first cut_off lines instead
+    assert guess_attributes("tests/data/tagesschau-mini.vrt.gz", 1000, sample=8)['stats']['nr_lines'] == 1000
+
+
+def test_parts(tmp_path):
+
+    data = gzip.open("tests/data/tagesschau-mini.vrt.gz").read()
+    path_in = str(tmp_path / "tagesschau-mini.vrt.gz")
+    with open_vrt(path_in, "wb", bgzf=True) as f:
+        f.write(data)
+
+    paths = write_parts(path_in, str(tmp_path / "parts"), 'article', 3, jobs=2)
+    assert len(paths) == 3
+    parts = [gzip.open(p).read() for p in paths]
+    for part in parts:
+        assert part.startswith(b"<corpus>\n<article ") and part.endswith(b"</article>\n</corpus>\n")
+    # without the repeated enclosing tags, parts add up to the original
+    assert parts[0][:-len(b"</corpus>\n")] + parts[1][len(b"<corpus>\n"): -len(b"</corpus>\n")] + \
+        parts[2][len(b"<corpus>\n"):] == data
+
+    path_out = str(tmp_path / "encode.sh")
+    process_path(path_in, path_out, False, "mini", ['pos'], 1000000, "data/", "registry/", False,
+                 jobs=2, parts=3, level='article', memory=1024)
+    script = open(path_out).read()
+    assert '-f "$parts_dir/part-$1.vrt.gz"' in script and "xargs -P $jobs" in script and "memory=1024" in script
+    assert len(list((tmp_path / "encode-parts").iterdir())) == 3
+
+
+def test_parts_cohorts(tmp_path):
+
+    # articles grouped by date: later parts are enclosed in other cohorts than the first one
+    data = gzip.open("tests/data/tagesschau-mini.vrt.gz").read()
+    body = data[len(b"<corpus>\n"): -len(b"</corpus>\n")]
+    articles = [b"<article " + a for a in body.split(b"<article ")[1:]]
+    cohorts = dict()
+    for article in articles:
+        date = re.search(rb'date="([^"]*)"', article).group(1)
+        cohorts.setdefault(date, list()).append(article)
+    data = b"<corpus>\n" + b"".join(
+        b'<cohort id="' + date + b'">\n' + b"".join(a) + b"</cohort>\n" for date, a in cohorts.items()
+    ) + b"</corpus>\n"
+    assert len(cohorts) > 3
+    path_in = str(tmp_path / "cohorts.vrt.gz")
+    with open_vrt(path_in, "wb", bgzf=True) as f:
+        f.write(data)
+
+    paths = write_parts(path_in, str(tmp_path / "parts"), 'article', 3)
+    assert len(paths) == 3
+    parts = [gzip.open(p).read() for p in paths]
+    rest = data
+    for nr, part in enumerate(parts):
+        first = part.index(b"<article ")
+        last = part.rindex(b"</article>\n") + len(b"</article>\n")
+        # opened in the cohort of the first article
+        date = re.search(rb'date="([^"]*)"', part[first:]).group(1)
+        assert part[:first].endswith(b'<cohort id="' + date + b'">\n')
+        assert list(iter_events(io.BytesIO(part)))[-1][2] == b"</corpus>"
+        # without the added tags, parts add up to the original
+        head = part if nr == len(parts) - 1 else part[:last]
+        if nr > 0:
+            head = head[first:]
+            rest = rest[rest.index(b"<article "):]
+        assert rest.startswith(head)
+        rest = rest[len(head):]
+        # every part is well-formed
+        assert part.count(b"<cohort ") == part.count(b"</cohort>")
+    assert rest == b""
+
+
+def test_pipe(tmp_path):
+
+    path_out = str(tmp_path / "pipe.sh")
+    path_in_plain = str(tmp_path / "plain.vrt")
+    with open(path_in_plain, "wb") as f:
+        f.write(gzip.open("tests/data/tagesschau-mini.vrt.gz").read())
+    process_path("tests/data/tagesschau-mini.vrt.gz", path_out, False, None, ['pos', 'lemma'], 1000000,
+                 "data/", "registry/", True, pipe=True)
+    script = open(path_out).read()
+    assert '$decompress "$path_in" | cwb-encode -d $data_subdir -R' in script
+    assert "-f $path_in" not in script
+    assert "| $compress > $file_out" in script and "-lemma.vrt.gz" in script
+
+    # plain input is not overwritten by the export
+    process_path(path_in_plain, path_out, True, None, ['pos', 'lemma'], 1000000,
+                 "data/", "registry/", True, pipe=True)
+    assert f'file_out="{str(tmp_path / "plain-lemma.vrt.gz")}"' in open(path_out).read()
+
+    # attributes are guessed from the output of the command
+    command = "gzip -dc tests/data/tagesschau-mini.vrt.gz | sed 's/<article /<text /; s/<\\/article>/<\\/text>/'"
+    process_path("tests/data/tagesschau-mini.vrt.gz", path_out, True, None, ['pos', 'lemma'], 1000,
+                 "data/", "registry/", False, input_command=command)
+    script = open(path_out).read()
+    assert f"{command} | cwb-encode" in script
+    assert "-S text:0+date+fname+month+rubrik+year" in script
+
+    # every process of the command is stopped once the attributes are guessed
+    marker = tmp_path / "finished"
+    process_path("tests/data/tagesschau-mini.vrt.gz", path_out, True, None, ['pos', 'lemma'], 1000,
+                 "data/", "registry/", False, input_command=f"yes w | (head -c 20000000; sleep 1; touch {marker})")
+    time.sleep(1.5)
+    assert not marker.exists()
+
+    # the whole output is not scanned
+    with pytest.raises(ValueError):
+        process_path("tests/data/tagesschau-mini.vrt.gz", path_out, True, None, ['pos', 'lemma'], 0,
+                     "data/", "registry/", False, input_command=command)
+
+
+def test_scan_schema_invalid():
+
+    # an invalid line must not hide the annotations of later lines with the same signature
+    data = b'<text id="a<b" x="1">\nw\n</text>\n<text id="c" x="2">\nw\n</text>\n'
+    schema = scan_schema(iter_events(io.BytesIO(data)))
+    assert schema['s_atts'] == {'text': {'id', 'x'}}
+    assert schema['nr_s_lines'] == 2 and schema['nr_p_lines'] == 2
@@ -0,0 +1,76 @@
+import gzip
+from argparse import Namespace
+
+from vrt.bgzf import is_bgzf_file, open_bgzf
+from vrt.merge import add_paths, main, read_cohorts_info
+from vrt.stream import open_vrt
+
+
+def write_cohorts(tmp_path, bgzf=False):
+
+    lines = gzip.open("tests/data/tagesschau-mini.vrt.gz").read().split(b"\n")
+    with open(tmp_path / "info-1.tsv", "wt") as f:
+        f.write("cohort_idx\tcohort_clear\tyear\n")
+        for nr in range(3):
+            name = f"c{nr}"
+            with open_vrt(str(tmp_path / f"{name}.vrt.gz"), "wb", bgzf=bgzf) as f_cohort:
+                f_cohort.write(b"\n".join(lines[nr * 1000: (nr + 1) * 1000]) + b"\n")
+            f.write(f"{name}\tcohort {nr}\t{2000 - nr}\n")
+
+
+def merge(tmp_path, name, **kwargs):
+    path_out = str(tmp_path / f"merged-{name}.vrt.gz")
+    args = dict(glob_in=str(tmp_path / "c*.vrt.gz"), path_out=path_out, force=False, cohorts_info=str(tmp_path / "info-*.tsv"),
+                name="TEST", order=["year"], bgzf=False, threads=1, recompress=False, jobs=1)
+    args.update(kwargs)
+    main(Namespace(**args))
+    return path_out
+
+
+def test_merge_copy(tmp_path):
+
+    write_cohorts(tmp_path)
+    path_copy = merge(tmp_path, "copy")
+    path_recompress = merge(tmp_path, "recompress", recompress=True)
+
+    merged = gzip.open(path_copy).read()
+    assert merged == gzip.open(path_recompress).read()
+    assert merged.startswith(b'<corpus name="TEST">\n<text id="cohort 2" year="1998">\n')
+    assert merged.endswith(b"</text>\n</corpus>\n")
+
+    # without cohorts info: plain concatenation
+    path_plain = merge(tmp_path, "plain", cohorts_info=None)
+    assert gzip.open(path_plain).read().count(b"<text ") == 0
+
+
+def test_merge_bgzf(tmp_path):
+
+    write_cohorts(tmp_path, bgzf=True)
+    path_copy = merge(tmp_path, "copy", bgzf=True)
+    path_recompress = merge(tmp_path, "recompress", bgzf=True, recompress=True)
+
+    assert is_bgzf_file(path_copy)
+    merged = gzip.open(path_recompress).read()
+    with open_bgzf(path_copy) as f:
+        assert f.read() == merged
+        f.seek(50000)
+        assert f.read(100) == merged[50000: 50100]
+
+
+def test_read_cohorts_info(tmp_path):
+
+    for nr in range(2):
+        with open(tmp_path / f"info-{nr}.tsv", "wt") as f:
+            f.write("cohort_idx\tcohort_clear\tyear\tcounts\n")
+            f.write(f"a\tA\t2000\t{nr + 1}\n")
+            f.write(f"b{nr}\tB\t\t1\n")
+
+    paths = sorted(str(p) for p in tmp_path.glob("info-*.tsv"))
+    for jobs in [1, 2]:
+        df = read_cohorts_info(paths, jobs=jobs)
+        assert df.index.tolist() == ['a', 'b0', 'b1']
+        assert df['counts'].tolist() == [3, 1, 1]
+        assert df['year'].tolist() == ['2000', '', '']
+
+    meta = add_paths(df, ["x/a.vrt.gz", "x/b1.vrt.gz"])
+    assert meta['path'].tolist() == ["x/a.vrt.gz", "x/b1.vrt.gz"]
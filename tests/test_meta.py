@@ -1,4 +1,13 @@
-from vrt.meta import process_path
+from argparse import Namespace
+from io import BytesIO
+from shutil import copyfile
+
+import pytest
+from pandas import read_csv
+
+from vrt.meta import Meta, collect, main, process_path
+from vrt.parquet import PartWriter, read_meta
+from vrt.stream import iter_events
 
 
 def test_process_path():
@@ -12,3 +21,105 @@ def test_process_path():
         [],
         None
     )
+
+
+def test_main_jobs(tmp_path):
+
+    for i in range(3):
+        copyfile("tests/data/tagesschau-mini.vrt.gz", tmp_path / f"tagesschau-{i}.vrt.gz")
+
+    dfs = list()
+    for jobs in [1, 3]:
+        path_out = str(tmp_path / f"meta-{jobs}.tsv.gz")
+        main(Namespace(glob_in=str(tmp_path / "tagesschau-*.vrt.gz"), path_out=path_out, force=False,
+                       level="article", index="fname", extra=[], tokens=True, s_atts=["s"], shards=1, jobs=jobs, parquet=False))
+        dfs.append(read_csv(path_out, sep="\t", dtype=str))
+
+    assert len(dfs[0]) == 3 * 169
+    assert dfs[0].equals(dfs[1])
+
+
+def test_meta_columns():
+
+    rows = [
+        {'id': '1', 'a': 'x', 'n': '1'},
+        {'id': '2', 'b': 'y', 'n': '2'},
+        {'id': '3', 'a': 'x', 'c': 'z', 'n': '3'},
+        {'id': '4', 'a': 'x', 'n': '4'}
+    ]
+
+    dfs = list()
+    for chunk_size in [1, 3, 100]:
+        meta = Meta(chunk_size=chunk_size)
+        for row in rows:
+            meta.add_meta_dict(row)
+        dfs.append(meta.get_df())
+
+    for df in dfs:
+        assert list(df.index) == ['1', '2', '3', '4']
+        assert list(df.columns) == ['a', 'n', 'b', 'c']
+        assert df['a'].isna().sum() == 1
+        assert df['c'].isna().sum() == 3
+        assert df.astype(object).equals(dfs[0].astype(object))
+
+    meta = Meta(chunk_size=3, infer_types=True)
+    for row in rows:
+        meta.add_meta_dict(row)
+    assert meta.get_df()['n'].sum() == 10
+
+
+def test_parquet(tmp_path):
+
+    pytest.importorskip("pyarrow")
+
+    for p in ["tagesschau-1.vrt.gz", "tagesschau-2.vrt.gz"]:
+        copyfile("tests/data/tagesschau-mini.vrt.gz", tmp_path / p)
+
+    path_tsv = str(tmp_path / "meta.tsv.gz")
+    path_parquet = str(tmp_path / "meta.parquet")
+    for path_out in [path_tsv, path_parquet]:
+        main(Namespace(glob_in=str(tmp_path / "tagesschau-*.vrt.gz"), path_out=path_out, force=False,
+                       level="article", index="fname", extra=[], tokens=True, s_atts=["s"], shards=1, jobs=1, parquet=False))
+
+    tsv = read_csv(path_tsv, sep="\t", dtype=str, index_col="id")
+    parquet = read_meta(path_parquet)
+    assert list(parquet.columns) == list(tsv.columns)
+    assert parquet.index.equals(tsv.index)
+    assert (parquet['nr_tokens'].astype(str) == tsv['nr_tokens']).all()
+    assert (parquet['rubrik'].astype(str) == tsv['rubrik']).all()
+
+    # schema evolution: attributes only encountered in later parts
+    meta = Meta(chunk_size=2, sink=PartWriter(str(tmp_path / "evolve.parquet")))
+    for row in [{'id': '1', 'a': 'x'}, {'id': '2', 'a': 'y'}, {'id': '3', 'b': 'z'}]:
+        meta.add_meta_dict(row, counts={'nr_tokens': 1})
+    meta.flush()
+    df = read_meta(str(tmp_path / "evolve.parquet"))
+    assert list(df.columns) == ['a', 'nr_tokens', 'b']
+    assert df['b'].isna().sum() == 2
+
+    # optional attribute: dictionary-encoded column with nulls inside one chunk
+    meta = Meta(chunk_size=10, sink=PartWriter(str(tmp_path / "optional.parquet")))
+    for nr in range(10):
+        row = {'id': str(nr), 'a': 'x'}
+        if nr % 3 == 0:
+            row['b'] = 'y'
+        meta.add_meta_dict(row)
+    meta.flush()
+    df = read_meta(str(tmp_path / "optional.parquet"))
+    assert df['b'].isna().tolist() == [nr % 3 != 0 for nr in range(10)]
+    assert (df['b'].dropna() == 'y').all()
+
+
+def test_collect_counts():
+
+    lines = [
+        b'<text id="a">', b'<p>', b'<s>', b'x', b'y', b'</s>', b'<s>', b'z', b'</s>', b'</p>', b'</text>',
+        b'<text id="b">', b'<p>', b'</p>', b'w', b'</text>'
+    ]
+    events = list(iter_events(BytesIO(b"\n".join(lines))))
+    df = collect(iter(events), 'text', True, [], 'id', ['s', 'p', 'text', 'x']).get_df()
+    assert df['nr_tokens'].tolist() == [3, 1]
+    assert df['nr_s'].tolist() == [2, 0]
+    assert df['nr_p'].tolist() == [1, 1]
+    assert df['nr_text'].tolist() == [0, 0]
+    assert df['nr_x'].tolist() == [0, 0]
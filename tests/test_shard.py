@@ -0,0 +1,57 @@
+import gzip
+
+from vrt.cqpweb import process_path as cqpweb
+from vrt.deduplicate import fingerprint
+from vrt.meta import process_path as meta
+from vrt.shard import find_shards, iter_shard
+from vrt.stream import iter_path, open_vrt
+
+
+def write_copies(tmp_path):
+    data = gzip.open("tests/data/tagesschau-mini.vrt.gz").read()
+    path_plain = str(tmp_path / "plain.vrt")
+    with open(path_plain, "wb") as f:
+        f.write(data)
+    path_bgzf = str(tmp_path / "bgzf.vrt.gz")
+    with open_vrt(path_bgzf, "wb", bgzf=True) as f:
+        f.write(data)
+    return path_plain, path_bgzf
+
+
+def test_find_shards(tmp_path):
+
+    for path in write_copies(tmp_path):
+        shards = find_shards(path, 'article', 4)
+        assert len(shards) == 4
+        assert shards[0][0] == 0 and shards[-1][1] is None
+        events = list()
+        for shard in shards:
+            events.extend(iter_shard(path, shard))
+        assert events == list(iter_path(path))
+
+    # plain gzip cannot be sharded
+    assert len(find_shards("tests/data/tagesschau-mini.vrt.gz", 'article', 4)) == 1
+
+
+def test_sharded_meta(tmp_path):
+
+    path_plain, path_bgzf = write_copies(tmp_path)
+    serial = meta(path_plain, None, True, 'article', True, [], 'fname', ['s', 'p']).get_df()
+    sharded = meta(path_bgzf, None, True, 'article', True, [], 'fname', ['s', 'p'], shards=3).get_df()
+    assert serial.equals(sharded)
+
+
+def test_sharded_fingerprint(tmp_path):
+
+    path_plain, path_bgzf = write_copies(tmp_path)
+    serial = fingerprint(path_plain, level='p')
+    sharded = fingerprint(path_plain, level='p', shards=3)
+    assert serial == sharded
+
+
+def test_sharded_cqpweb(tmp_path):
+
+    path_plain, path_bgzf = write_copies(tmp_path)
+    cqpweb(path_plain, str(tmp_path / "serial.vrt.gz"), True, 'article', 'year', ['month'])
+    cqpweb(path_bgzf, str(tmp_path / "sharded.vrt.gz"), True, 'article', 'year', ['month'], shards=3)
+    assert gzip.open(tmp_path / "serial.vrt.gz").read() == gzip.open(tmp_path / "sharded.vrt.gz").read()
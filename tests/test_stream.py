@@ -0,0 +1,35 @@
+from io import BytesIO
+
+from vrt.stream import (DECLARATION, P_ATT, S_CLOSE, S_OPEN, iter_events,
+                        iter_lines, iter_path)
+
+
+def test_iter_lines():
+
+    f = BytesIO(b"<s>\r\nein\tART\nTest\tNN\n</s>")
+    lines = list(iter_lines(f, chunk_size=3))
+    assert lines == [b"<s>", b"ein\tART", b"Test\tNN", b"</s>"]
+
+
+def test_iter_events():
+
+    f = BytesIO(b'<?xml version="1.0"?>\n<text id="a">\n<s>\nTest\tNN\n\n</s>\n</text>\n')
+    events = [(kind, name) for kind, name, line in iter_events(f)]
+    assert events == [
+        (DECLARATION, None),
+        (S_OPEN, 'text'),
+        (S_OPEN, 's'),
+        (P_ATT, None),
+        (P_ATT, None),
+        (S_CLOSE, 's'),
+        (S_CLOSE, 'text')
+    ]
+
+
+def test_iter_path():
+
+    counts = {P_ATT: 0, S_OPEN: 0, S_CLOSE: 0}
+    for kind, name, line in iter_path("tests/data/tagesschau-mini.vrt.gz"):
+        counts[kind] += 1
+    assert counts[S_OPEN] == counts[S_CLOSE]
+    assert counts[P_ATT] > 0
@@ -0,0 +1,61 @@
+import gzip
+import random
+
+from vrt.utils import IdAllocator, MultiFileWriter, save_id
+
+
+def test_multi_file_writer(tmp_path):
+
+    paths = [str(tmp_path / "sub" / f"{nr}.txt.gz") for nr in range(5)]
+    expected = {p: list() for p in paths}
+
+    with MultiFileWriter(limit=2, buffer_size=20) as writer:
+        for i in range(100):
+            p = paths[(i * 7) % 5]
+            writer.write(p, f"line {i}\n")
+            expected[p].append(f"line {i}\n")
+
+    for p in paths:
+        assert gzip.open(p, "rt").read() == "".join(expected[p])
+
+    assert len(writer.connections) == 0
+    assert writer.nr_evict > 0 and writer.nr_reopen > 0
+    assert writer.nr_open == 5 + writer.nr_reopen
+
+
+def test_multi_file_writer_buffered(tmp_path):
+
+    # large buffers: every file is written in one block and never reopened
+    paths = [str(tmp_path / f"{nr}.txt") for nr in range(10)]
+    with MultiFileWriter(compression=None, limit=2) as writer:
+        for i in range(1000):
+            writer.write(paths[i % 10], f"{i}\n")
+
+    assert writer.nr_flush == 10 and writer.nr_reopen == 0
+    assert open(paths[3]).read().split() == [str(i) for i in range(3, 1000, 10)]
+
+
+def test_id_allocator():
+
+    rng = random.Random(1)
+    bases = ["a", "a__1", "a__3", "a__07", "b", "b__2__1", "12"]
+    stream = [rng.choice(bases) for _ in range(2000)]
+
+    ids = set()
+    expected = list()
+    for id in stream:
+        id = save_id(id, ids)
+        ids.add(id)
+        expected.append(id)
+
+    allocator = IdAllocator()
+    assert [allocator.allocate(id) for id in stream] == expected
+    assert allocator.ids == ids
+
+    # shared set updated elsewhere
+    ids = {"x", "x__2"}
+    allocator = IdAllocator(ids)
+    assert allocator.allocate("x") == "x__1"
+    ids.add("x__3")
+    assert allocator.allocate("x") == "x__4"
+    assert "x__4" in ids
@@ -0,0 +1,75 @@
+import gzip
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from vrt.stream import S_OPEN, iter_path
+from vrt.vrt import _meta2dict_etree, force_categorical, iter_s, meta2dict
+
+
+@pytest.mark.parametrize("line", [
+    '<text id="a">',
+    '<text id="a" >\n',
+    '<text id = "a" b="c">',
+    "<text id='a'>",
+    '<text id="a & b" url="http://x.org?a=1&amp;b=2">',
+    '<text id="  a\tb  ">',
+    '<text id="a>b">',
+    '<text xml:lang="de">',
+    '<text xmlns="u">',
+    '<text>',
+    '<text id="a"b="c">',
+    '<text a="1" a="2">',
+    '<text id="x"/>',
+    '<text id="a<b">',
+    '<article id="a">',
+])
+def test_meta2dict(line):
+
+    try:
+        expected = _meta2dict_etree(line, level='text')
+    except ET.ParseError:
+        with pytest.raises(ET.ParseError):
+            meta2dict(line, level='text')
+    else:
+        assert meta2dict(line, level='text') == expected
+
+
+def test_meta2dict_file():
+
+    for kind, name, line in iter_path("tests/data/tagesschau-mini.vrt.gz"):
+        if kind == S_OPEN:
+            line = line.decode()
+            assert meta2dict(line, level=name) == _meta2dict_etree(line, level=name)
+
+
+def test_meta2dict_copy():
+
+    # cached results must not be shared between calls
+    meta = meta2dict('<text id="a">')
+    meta['id'] = 'b'
+    assert meta2dict('<text id="a">') == {'id': 'a'}
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("Übergröße", "uebergroesse"),
+    ("Inland / Ausland", "inland___ausland"),
+    ("a-b|c", "a_b_c"),
+    ("2009", "c_2009"),
+    ("Café", "cafe"),
+    ("漢字", "NA"),
+    ("", "NA"),
+])
+def test_force_categorical(text, expected):
+
+    assert force_categorical(text) == force_categorical(text) == expected
+
+
+def test_iter_s_text_mode():
+
+    with gzip.open("tests/data/tagesschau-mini.vrt.gz", "rb") as f:
+        regions = list(iter_s(f, level='article'))
+    # text-mode file objects are accepted as well
+    with gzip.open("tests/data/tagesschau-mini.vrt.gz", "rt") as f:
+        assert list(iter_s(f, level='article')) == regions
+    assert len(regions) == 169
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""reading and writing of blocked gzip files (BGZF)
+
+BGZF files (as used by samtools/htslib) are ordinary multi-member gzip
+files where every member holds at most 64 KiB of uncompressed data and
+stores its compressed size in an extra header field.  they can be read
+by any gzip reader, but blocks can also be located without inflating
+them, which allows
+
+- compressing and decompressing blocks on several threads at once
+- seeking to uncompressed offsets via a block index (.gzi sidecar)
+
+zlib releases the GIL while (de)compressing, so threads suffice.
+
+"""
+
+import io
+import os
+import struct
+import sys
+import zlib
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+# uncompressed bytes per block (as in htslib, leaves room for incompressible data)
+BLOCK_SIZE = 0xff00
+
+# number of blocks handed to the thread pool at once (per thread)
+BATCH_SIZE = 16
+
+# gzip header with FEXTRA, XLEN=6, subfield "BC" of length 2 holding BSIZE
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_HEADER_MAGIC = (31, 139, 8, 4)
+_FOOTER = struct.Struct("<II")
+_INDEX_ENTRY = struct.Struct("<QQ")
+
+# empty block marking the end of file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def is_bgzf_file(path):
+    """does path start with a BGZF block?"""
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return False
+    fields = _HEADER.unpack(header)
+    return fields[:4] == _HEADER_MAGIC and fields[8:10] == (66, 67)
+
+
+def compress_block(data, level=6):
+    """compress data (at most BLOCK_SIZE bytes) into one BGZF block"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) + _HEADER.size + _FOOTER.size > 1 << 16:
+        # incompressible data: store
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    bsize = len(cdata) + _HEADER.size + _FOOTER.size - 1
+    return b"".join([
+        _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize),
+        cdata,
+        _FOOTER.pack(zlib.crc32(data), len(data))
+    ])
+
+
+def decompress_block(block):
+    """decompress one BGZF block"""
+    data = zlib.decompress(block[_HEADER.size:-_FOOTER.size], -15)
+    crc, size = _FOOTER.unpack(block[-_FOOTER.size:])
+    if size != len(data) or crc != zlib.crc32(data):
+        raise OSError("BGZF block is corrupt (CRC or size mismatch)")
+    return data
+
+
+def read_block(f):
+    """read raw BGZF block from binary file object f (None at end of file)"""
+    header = f.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise EOFError("BGZF file ended in the middle of a block header")
+    fields = _HEADER.unpack(header)
+    if fields[:4] != _HEADER_MAGIC or fields[8:10] != (66, 67):
+        raise OSError("not a BGZF block")
+    rest = f.read(fields[-1] + 1 - _HEADER.size)
+    if len(rest) < fields[-1] + 1 - _HEADER.size:
+        raise EOFError("BGZF file ended in the middle of a block")
+    return header + rest
+
+
+def read_index(path):
+    """read .gzi block index: list of (compressed offset, uncompressed offset)"""
+    with open(path, "rb") as f:
+        nr = struct.unpack("<Q", f.read(8))[0]
+        entries = [_INDEX_ENTRY.unpack(f.read(_INDEX_ENTRY.size)) for _ in range(nr)]
+    return [(0, 0)] + entries
+
+
+def write_index(path, index):
+    """write .gzi block index (the first block at (0, 0) is implicit)"""
+    entries = [e for e in index if e != (0, 0)]
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(entries)))
+        for entry in entries:
+            f.write(_INDEX_ENTRY.pack(*entry))
+
+
+def build_index(path):
+    """create block index by skipping through block headers"""
+    index = list()
+    c_offset = u_offset = 0
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            fields = _HEADER.unpack(header)
+            bsize = fields[-1] + 1
+            f.seek(bsize - _HEADER.size - 4, os.SEEK_CUR)
+            size = struct.unpack("<I", f.read(4))[0]
+            if size > 0:
+                index.append((c_offset, u_offset))
+            c_offset += bsize
+            u_offset += size
+    return index
+
+
+def is_valid_index(path, index):
+    """does the block index still fit the file: not older than it and its last entry pointing at a block?"""
+    path_index = path + ".gzi"
+    if os.path.getmtime(path_index) < os.path.getmtime(path):
+        return False
+    with open(path, "rb") as f:
+        f.seek(index[-1][0])
+        try:
+            return read_block(f) is not None
+        except (OSError, EOFError):
+            return False
+
+
+def load_index(path, write=False):
+    """block index of BGZF file from {path}.gzi, built from the file if the
+    sidecar is missing or stale (written to {path}.gzi with write=True)
+
+    """
+    path_index = path + ".gzi"
+    if os.path.exists(path_index):
+        index = read_index(path_index)
+        if is_valid_index(path, index):
+            return index
+        print(f'warning: block index "{path_index}" is stale, rebuilding it', file=sys.stderr)
+    index = build_index(path)
+    if write:
+        write_index(path_index, index)
+    return index
+
+
+class BgzfWriter(io.RawIOBase):
+    """write BGZF file, compressing blocks on {threads} threads
+
+    the block index is written to {path}.gzi on close (unless index=False)
+    """
+
+    def __init__(self, path, threads=1, level=6, index=True):
+
+        self.path = path
+        self.f = open(path, "wb")
+        self.threads = threads
+        self.level = level
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.write_gzi = index
+
+        self.buffer = bytearray()
+        self.index = list()     # (compressed offset, uncompressed offset) of each block
+        self.c_offset = 0
+        self.u_offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= BLOCK_SIZE * BATCH_SIZE * self.threads:
+            self._flush_blocks(final=False)
+        return len(data)
+
+    def _flush_blocks(self, final):
+        nr_blocks = len(self.buffer) // BLOCK_SIZE
+        if final and len(self.buffer) % BLOCK_SIZE:
+            nr_blocks += 1
+        chunks = [bytes(self.buffer[i * BLOCK_SIZE: (i + 1) * BLOCK_SIZE]) for i in range(nr_blocks)]
+        del self.buffer[:nr_blocks * BLOCK_SIZE]
+
+        if self.pool is not None:
+            blocks = self.pool.map(compress_block, chunks, [self.level] * len(chunks))
+        else:
+            blocks = (compress_block(chunk, self.level) for chunk in chunks)
+
+        for chunk, block in zip(chunks, blocks):
+            self.index.append((self.c_offset, self.u_offset))
+            self.f.write(block)
+            self.c_offset += len(block)
+            self.u_offset += len(chunk)
+
+    def close(self):
+        if self.closed:
+            return
+        self._flush_blocks(final=True)
+        self.f.write(EOF_BLOCK)
+        self.f.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.write_gzi:
+            write_index(self.path + ".gzi", self.index)
+        super().close()
+
+
+class BgzfReader(io.RawIOBase):
+    """read BGZF file, decompressing blocks on {threads} threads
+
+    seeking to uncompressed offsets uses the block index {path}.gzi
+    (created on the fly by skipping through block headers if missing)
+    """
+
+    def __init__(self, path, threads=1):
+
+        self.path = path
+        self.f = open(path, "rb")
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+
+        self.index = None
+        self.u_offsets = None   # uncompressed offsets of the blocks in self.index
+        self.data = b""         # decompressed data of current batch
+        self.pos = 0            # position in self.data
+        self.offset = 0         # uncompressed offset of self.data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _next_batch(self, nr_blocks=None):
+        blocks = list()
+        for _ in range(BATCH_SIZE * self.threads if nr_blocks is None else nr_blocks):
+            block = read_block(self.f)
+            if block is None:
+                break
+            blocks.append(block)
+        if self.pool is not None:
+            data = b"".join(self.pool.map(decompress_block, blocks))
+        else:
+            data = b"".join(decompress_block(block) for block in blocks)
+        self.offset += len(self.data)
+        self.data = data
+        self.pos = 0
+        return len(blocks) > 0
+
+    def readinto(self, b):
+        while self.pos >= len(self.data):
+            if not self._next_batch():
+                return 0
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos: self.pos + n]
+        self.pos += n
+        return n
+
+    def tell(self):
+        return self.offset + self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.tell()
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can only seek relative to start or current position")
+
+        if self.index is None:
+            self.index = load_index(self.path)
+            self.u_offsets = [u for c, u in self.index]
+
+        i = bisect_right(self.u_offsets, offset) - 1
+        c_offset, u_offset = self.index[i] if i >= 0 else (0, 0)
+        self.f.seek(c_offset)
+        self.data = b""
+        self.pos = 0
+        self.offset = u_offset
+        while self.offset + len(self.data) <= offset:
+            if not self._next_batch(nr_blocks=1):
+                break
+        self.pos = min(offset - self.offset, len(self.data))
+        return self.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        self.f.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+        super().close()
+
+
+def open_bgzf(path, mode="rb", threads=1, level=6, index=True):
+    """open BGZF file for reading or writing (binary or text mode)
+
+    """
+
+    if "r" in mode:
+        raw = BgzfReader(path, threads=threads)
+        buffered = io.BufferedReader(raw, buffer_size=BLOCK_SIZE)
+    else:
+        raw = BgzfWriter(path, threads=threads, level=level, index=index)
+        buffered = io.BufferedWriter(raw, buffer_size=BLOCK_SIZE)
+
+    if "t" in mode:
+        return io.TextIOWrapper(buffered, encoding="utf-8")
+    return buffered
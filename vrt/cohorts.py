@@ -4,14 +4,19 @@
 import gzip
 import os
 from collections import defaultdict
+from functools import partial
 from glob import glob
+from shutil import copyfileobj
+from struct import Struct
 from tempfile import TemporaryDirectory
 
-from vrt.utils import MultiFileWriter, Progress, save_path_out
+from vrt.bgzf import BLOCK_SIZE, EOF_BLOCK, build_index, compress_block, write_index
+from vrt.stream import open_vrt
+from vrt.utils import MultiFileWriter, Progress, merge_files, multi_proc, save_path_out
 from vrt.vrt import dict2meta, iter_s
 
 
-def cohort_in_memory(paths_in, path_out, level_old, level_new, level_cohort, categorical):
+def cohort_in_memory(paths_in, path_out, level_old, level_new, level_cohort, categorical, bgzf=False, threads=1):
 
     print("sorting into cohorts in memory")
     cohorts = defaultdict(list)
@@ -20,7 +25,7 @@ def cohort_in_memory(paths_in, path_out, level_old, level_new, level_cohort, cat
     for path_in in paths_in:
         print(path_in)
         pb = Progress()
-        with gzip.open(path_in, "rt") as f_in:
+        with open_vrt(path_in, threads=threads) as f_in:
             for text, meta in iter_s(f_in, level=level_old):
                 cohort_id = "_".join([meta[c] for c in categorical])
                 cohort_meta = {c: meta[c] for c in categorical}
@@ -36,7 +41,7 @@ def cohort_in_memory(paths_in, path_out, level_old, level_new, level_cohort, cat
 
     print("writing")
     pb = Progress(length=len(cohorts))
-    with gzip.open(path_out, "wt") as f_out:
+    with open_vrt(path_out, "wt", threads=threads, bgzf=bgzf) as f_out:
         f_out.write("<corpus>\n")
         for cohort_id in cohorts_id:
             f_out.write(dict2meta(cohorts_meta[cohort_id], level=level_cohort))
@@ -46,7 +51,7 @@ def cohort_in_memory(paths_in, path_out, level_old, level_new, level_cohort, cat
         f_out.write("</corpus>")
 
 
-def cohort_via_files(paths_in, path_out, level_old, level_new, level_cohort, categorical):
+def cohort_via_files(paths_in, path_out, level_old, level_new, level_cohort, categorical, bgzf=False, threads=1, jobs=1):
 
     with TemporaryDirectory() as tmp_dir:
 
@@ -54,50 +59,204 @@ def cohort_via_files(paths_in, path_out, level_old, level_new, level_cohort, cat
         cohorts_id = list()
         cohorts_meta = dict()
         paths = list()
-        writer = MultiFileWriter()
+
+        with MultiFileWriter() as writer:
+            for path_in in paths_in:
+                print(path_in)
+                pb = Progress()
+                with open_vrt(path_in, threads=threads) as f_in:
+                    for text, meta in iter_s(f_in, level=level_old):
+                        cohort_id = "_".join([meta[c] for c in categorical])
+                        cohort_meta = {c: meta[c] for c in categorical}
+                        path = os.path.join(tmp_dir, cohort_id + ".vrt.gz")
+                        if cohort_id not in cohorts_meta.keys():
+                            cohorts_meta[cohort_id] = cohort_meta
+                            cohorts_meta[cohort_id]['id'] = cohort_id
+                            cohorts_id.append(cohort_id)
+                            paths.append(path)
+                        writer.write(path, dict2meta(meta, level=level_new))
+                        writer.write(path, "\n".join(text) + "\n")
+                        writer.write(path, f"</{level_new}>" + "\n")
+                        pb.up()
+                pb.fine()
+        print(f".. {len(paths)} cohorts: {writer.nr_flush} blocks written, "
+              f"{writer.nr_reopen} files reopened, {writer.nr_evict} connections evicted")
+
+        print("collecting and writing")
+        items = [(p, dict2meta(cohorts_meta[cohort_id], level=level_cohort)) for p, cohort_id in zip(paths, cohorts_id)]
+        assemble_cohorts(items, path_out, level_cohort, bgzf, jobs)
+
+
+def _compress_member(item, level_cohort, bgzf=False):
+    """compress one cohort (opening tag, regions of temporary file, closing tag) into
+    an independent gzip member (BGZF blocks if bgzf) next to the temporary file
+
+    :return: path of compressed member
+    """
+
+    path_tmp, start = item
+    path_member = path_tmp + ".member"
+    with gzip.open(path_tmp, "rb") as f_in, open(path_member, "wb") as f_out:
+        if bgzf:
+            buffer = start.encode()
+            while True:
+                chunk = f_in.read(BLOCK_SIZE)
+                if not chunk:
+                    break
+                buffer += chunk
+                while len(buffer) >= BLOCK_SIZE:
+                    f_out.write(compress_block(buffer[:BLOCK_SIZE]))
+                    buffer = buffer[BLOCK_SIZE:]
+            buffer += f"</{level_cohort}>\n".encode()
+            for i in range(0, len(buffer), BLOCK_SIZE):
+                f_out.write(compress_block(buffer[i: i + BLOCK_SIZE]))
+        else:
+            with gzip.open(f_out, "wb", compresslevel=6) as f_member:
+                f_member.write(start.encode())
+                copyfileobj(f_in, f_member)
+                f_member.write(f"</{level_cohort}>\n".encode())
+    os.remove(path_tmp)
+    return path_member
+
+
+def assemble_cohorts(items, path_out, level_cohort, bgzf=False, jobs=1):
+    """compress cohorts (path of temporary file, opening tag) independently on {jobs}
+    processes and concatenate the compressed members in order (multi-member gzip / BGZF)
+
+    """
+
+    processor = partial(_compress_member, level_cohort=level_cohort, bgzf=bgzf)
+    members = multi_proc(processor, items, nr_cpus=jobs) if jobs > 1 else map(processor, items)
+
+    pb = Progress(length=len(items))
+    compress = compress_block if bgzf else gzip.compress
+    with open(path_out, "wb") as f_out:
+        f_out.write(compress(b"<corpus>\n"))
+        for path_member in members:
+            with open(path_member, "rb") as f_member:
+                copyfileobj(f_member, f_out)
+            os.remove(path_member)
+            pb.up()
+        f_out.write(compress(b"</corpus>"))
+        if bgzf:
+            f_out.write(EOF_BLOCK)
+    pb.fine()
+
+    if bgzf:
+        write_index(path_out + ".gzi", build_index(path_out))
+
+
+# header of region records in sort runs: cohort nr, sequence nr, length of region
+_RECORD = Struct(">IQI")
+
+
+def _write_records(records, path):
+    """write ((cohort nr, sequence nr), region) to run file"""
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        for (cohort_nr, seq), region in records:
+            f.write(_RECORD.pack(cohort_nr, seq, len(region)))
+            f.write(region)
+
+
+def _write_run(run, dir_tmp, nr):
+    """sort regions of run by cohort (stable: keeps input order) and write them to run file"""
+    path = os.path.join(dir_tmp, f"run-{nr:05d}.bin.gz")
+    run.sort(key=lambda record: record[0])
+    _write_records((((cohort_nr, seq), region) for cohort_nr, seq, region in run), path)
+    return path
+
+
+def _iter_run(path):
+    """yield ((cohort nr, sequence nr), region) from run file"""
+    with gzip.open(path, "rb") as f:
+        while True:
+            header = f.read(_RECORD.size)
+            if not header:
+                break
+            cohort_nr, seq, length = _RECORD.unpack(header)
+            yield (cohort_nr, seq), f.read(length)
+
+
+def merge_runs(paths, fan_in=None):
+    """yield ((cohort nr, sequence nr), region) of run files in sorted order (with at most {fan_in} open runs, see merge_files)"""
+    return merge_files(paths, _iter_run, _write_records, fan_in, suffix=".bin.gz")
+
+
+def cohort_via_sort(paths_in, path_out, level_old, level_new, level_cohort, categorical, bgzf=False, threads=1,
+                    run_size=1 << 28, fan_in=None):
+    """external merge sort: regions are tagged with the number of their cohort, sorted
+    in runs of at most {run_size} bytes, spilled to disk and merged (at most {fan_in} runs at once)
+
+    """
+
+    with TemporaryDirectory() as tmp_dir:
+
+        print(f"sorting into cohorts via sorted runs at {tmp_dir}/")
+        cohorts_id = list()
+        cohorts_meta = dict()
+        cohorts_nr = dict()
+        paths_runs = list()
+        run = list()
+        run_bytes = 0
+        seq = 0
 
         for path_in in paths_in:
             print(path_in)
             pb = Progress()
-            with gzip.open(path_in, "rt") as f_in:
+            with open_vrt(path_in, threads=threads) as f_in:
                 for text, meta in iter_s(f_in, level=level_old):
                     cohort_id = "_".join([meta[c] for c in categorical])
-                    cohort_meta = {c: meta[c] for c in categorical}
-                    path = os.path.join(tmp_dir, cohort_id + ".vrt.gz")
-                    if cohort_id not in cohorts_meta.keys():
-                        cohorts_meta[cohort_id] = cohort_meta
+                    if cohort_id not in cohorts_nr.keys():
+                        cohorts_nr[cohort_id] = len(cohorts_id)
+                        cohorts_meta[cohort_id] = {c: meta[c] for c in categorical}
                         cohorts_meta[cohort_id]['id'] = cohort_id
                         cohorts_id.append(cohort_id)
-                        paths.append(path)
-                    writer.write(path, dict2meta(meta, level=level_new))
-                    writer.write(path, "\n".join(text) + "\n")
-                    writer.write(path, f"</{level_new}>" + "\n")
+                    region = "".join([
+                        dict2meta(meta, level=level_new), "\n".join(text) + "\n", f"</{level_new}>" + "\n"
+                    ]).encode()
+                    run.append((cohorts_nr[cohort_id], seq, region))
+                    run_bytes += len(region)
+                    seq += 1
+                    if run_bytes >= run_size:
+                        paths_runs.append(_write_run(run, tmp_dir, len(paths_runs)))
+                        run = list()
+                        run_bytes = 0
                     pb.up()
-            writer.close()
             pb.fine()
+        if len(run) > 0:
+            paths_runs.append(_write_run(run, tmp_dir, len(paths_runs)))
+        print(f".. {len(cohorts_id)} cohorts, {seq} regions in {len(paths_runs)} sorted runs")
 
-        print("collecting and writing")
-        pb = Progress(length=len(paths))
-        with gzip.open(path_out, "wt") as f_out:
-            f_out.write("<corpus>\n")
-            for p, cohort_id in zip(paths, cohorts_id):
-                f_out.write(dict2meta(cohorts_meta[cohort_id], level=level_cohort))
-                with gzip.open(p, "rt") as f:
-                    for line in f:
-                        f_out.write(line)
-                f_out.write(f"</{level_cohort}>\n")
+        print("merging and writing")
+        pb = Progress(length=len(cohorts_id))
+        with open_vrt(path_out, "wb", threads=threads, bgzf=bgzf) as f_out:
+            f_out.write(b"<corpus>\n")
+            current = None
+            for (cohort_nr, seq), region in merge_runs(paths_runs, fan_in):
+                if cohort_nr != current:
+                    if current is not None:
+                        f_out.write(f"</{level_cohort}>\n".encode())
+                        pb.up()
+                    current = cohort_nr
+                    f_out.write(dict2meta(cohorts_meta[cohorts_id[cohort_nr]], level=level_cohort).encode())
+                f_out.write(region)
+            if current is not None:
+                f_out.write(f"</{level_cohort}>\n".encode())
                 pb.up()
-            f_out.write("</corpus>")
+            f_out.write(b"</corpus>")
 
 
-def process_paths(paths_in, path_out, force, level_old, level_new, level_cohort, categorical, memory=False):
+def process_paths(paths_in, path_out, force, level_old, level_new, level_cohort, categorical, memory=False, bgzf=False, threads=1,
+                  sort=False, run_size=1 << 28, jobs=1):
 
     f_name, path_out = save_path_out(paths_in[0], path_out, suffix='-cohorts.vrt.gz', force=force)
 
     if memory:
-        cohort_in_memory(paths_in, path_out, level_old, level_new, level_cohort, categorical)
+        cohort_in_memory(paths_in, path_out, level_old, level_new, level_cohort, categorical, bgzf, threads)
+    elif sort:
+        cohort_via_sort(paths_in, path_out, level_old, level_new, level_cohort, categorical, bgzf, threads, run_size)
     else:
-        cohort_via_files(paths_in, path_out, level_old, level_new, level_cohort, categorical)
+        cohort_via_files(paths_in, path_out, level_old, level_new, level_cohort, categorical, bgzf, threads, jobs)
 
 
 def main(args):
@@ -112,4 +271,9 @@ def main(args):
                   args.level_new,
                   args.level_cohort,
                   args.categorical,
-                  args.memory)
+                  args.memory,
+                  args.bgzf,
+                  args.threads,
+                  args.sort,
+                  args.run_size << 20,
+                  args.jobs)
@@ -2,13 +2,25 @@
 # -*- coding: utf-8 -*-
 
 import gzip
+import os
+import sys
 import xml
 import xml.etree.ElementTree as ET
 from collections import defaultdict
+from contextlib import nullcontext
+from functools import partial
+from shutil import copyfileobj
+from tempfile import TemporaryDirectory
+from timeit import default_timer
 
-from vrt.utils import Progress, is_gz_file, save_id, save_path_out
+from vrt.shard import find_shards, iter_shard
+from vrt.stream import P_ATT, S_CLOSE, S_OPEN, iter_path, open_vrt
+from vrt.utils import IdAllocator, Progress, is_gz_file, multi_proc, save_path_out
 from vrt.vrt import dict2meta, force_categorical, meta2dict
 
+# size of output batches (4 MiB)
+BATCH_SIZE = 1 << 22
+
 
 def parse_s_att(line):
     """"""
@@ -79,43 +91,183 @@ def check_file(path, cut_off=-1):
     # meta data types
 
 
-def process_path(path_in, path_out, force, level, id_attribute, categorical):
+def convert(events, f_out, level, id_attribute, categorical, ids=None, region_nr=0, final_ids=None, batch_size=BATCH_SIZE):
+    """write (kind, name, line)-events as CQPweb-compatible VRT to binary file object f_out
+
+    output is collected and written in batches of about {batch_size} bytes
+
+    :param set ids: IDs already in use (will be updated)
+    :param int region_nr: number of {level} regions before the first event (for fallback IDs)
+    :param list final_ids: IDs to use for the regions instead of resolving collisions via {ids}
 
-    f_name, path_out = save_path_out(path_in, path_out, suffix='-cqpweb.vrt.gz', force=force)
+    :return: IDs encountered, IDs assigned, values of categorical attributes, and
+             statistics (number of tokens, regions, and bytes written)
+    """
 
-    ids = set()
+    allocator = IdAllocator(ids)
+    encountered = list()
+    assigned = list()
     categorical_values = defaultdict(set)
-    with gzip.open(path_in, "rt") as f, gzip.open(path_out, "wt") as f_out:
-
-        text_count = 0
-        pb = Progress(rate=1)
-        for line in f:
-
-            if line.startswith(f"<{level}") or line.startswith(f"<{level}>"):
-                meta = meta2dict(line, level=level)
-                id_encountered = force_categorical(meta.pop(id_attribute, str(pb.c)))
-                id = save_id(id_encountered, ids)
-                meta['id'] = id
-                ids.add(id)
-                for c in categorical:
-                    key = force_categorical(c)
-                    value = force_categorical(meta.pop(c))
-                    meta[key] = value
-                    categorical_values[key].add(value)
-                line = dict2meta(meta)
-            elif line.startswith(f"</{level}>"):
-                line = "</text>" + "\n"
-                text_count += 1
-                pb.up()
-            elif line.startswith("<text ") or line.startswith("<text>") or line.startswith("</text>"):
-                continue
-
-            f_out.write(line)
 
-        pb.fine()
+    batch = list()
+    batch_bytes = 0
+    nr_bytes = 0
+    nr_tokens = 0
+
+    text_count = 0
+    pb = Progress(rate=1)
+    for kind, name, line in events:
+
+        if kind == P_ATT:
+            nr_tokens += 1
+        elif kind == S_OPEN and name == level:
+            meta = meta2dict(line.decode(), level=level)
+            id_encountered = force_categorical(meta.pop(id_attribute, str(region_nr + pb.c)))
+            if final_ids is None:
+                id = allocator.allocate(id_encountered)
+            else:
+                id = final_ids[text_count]
+            encountered.append(id_encountered)
+            assigned.append(id)
+            meta['id'] = id
+            for c in categorical:
+                key = force_categorical(c)
+                value = force_categorical(meta.pop(c))
+                meta[key] = value
+                categorical_values[key].add(value)
+            line = dict2meta(meta).encode()[:-1]
+        elif kind == S_CLOSE and name == level:
+            line = b"</text>"
+            text_count += 1
+            pb.up()
+        elif name == "text":
+            continue
+
+        batch.append(line)
+        batch_bytes += len(line) + 1
+        if batch_bytes >= batch_size:
+            batch.append(b"")
+            f_out.write(b"\n".join(batch))
+            nr_bytes += batch_bytes
+            batch = list()
+            batch_bytes = 0
+
+    if len(batch) > 0:
+        batch.append(b"")
+        f_out.write(b"\n".join(batch))
+        nr_bytes += batch_bytes
+
+    pb.fine()
+
+    stats = {'tokens': nr_tokens, 'regions': text_count, 'bytes': nr_bytes}
+
+    return encountered, assigned, categorical_values, stats
+
+
+def report_throughput(stats, seconds, file=sys.stdout):
+    """print throughput of conversion"""
+    seconds = max(seconds, 1e-9)
+    print(f"converted {stats['tokens']} tokens in {stats['regions']} regions "
+          f"({stats['bytes'] / 2 ** 20:.1f} MB) in {seconds:.1f} s: "
+          f"{stats['tokens'] / seconds / 1e6:.2f} M tokens/s, {stats['bytes'] / 2 ** 20 / seconds:.1f} MB/s", file=file)
+
+
+def _convert_shard(item, path_in, level, id_attribute, categorical):
+    """"""
+    shard, path_out, final_ids = item
+    with gzip.open(path_out, "wb") as f_out:
+        return convert(iter_shard(path_in, shard), f_out, level, id_attribute, categorical,
+                       region_nr=shard[2], final_ids=final_ids)
+
+
+def convert_sharded(path_in, path_out, nr_shards, level, id_attribute, categorical):
+    """convert shards of path_in on {nr_shards} processes
+
+    each shard resolves ID collisions locally; afterwards, IDs are
+    resolved across shards in order, and shards where this leads to
+    different IDs are converted again with the final IDs
+
+    path_out "-": write uncompressed VRT to stdout
+    """
+
+    shards = find_shards(path_in, level, nr_shards)
+    processor = partial(_convert_shard, path_in=path_in, level=level,
+                        id_attribute=id_attribute, categorical=categorical)
+
+    with TemporaryDirectory() as tmp_dir:
+
+        paths = [os.path.join(tmp_dir, f"{i}.vrt.gz") for i in range(len(shards))]
+        results = list(multi_proc(processor, [(shard, p, None) for shard, p in zip(shards, paths)],
+                                  nr_cpus=len(shards)))
+
+        # resolve IDs across shards
+        allocator = IdAllocator()
+        categorical_values = defaultdict(set)
+        stats = defaultdict(int)
+        rerun = list()
+        for shard, p, (encountered, assigned, values, shard_stats) in zip(shards, paths, results):
+            for key in shard_stats:
+                stats[key] += shard_stats[key]
+            final_ids = list()
+            for id_encountered in encountered:
+                final_ids.append(allocator.allocate(id_encountered))
+            if final_ids != assigned:
+                rerun.append((shard, p, final_ids))
+            for key in values:
+                categorical_values[key].update(values[key])
+
+        if len(rerun) > 0:
+            print(f"re-converting {len(rerun)} shard(s) with IDs colliding across shards", file=sys.stderr)
+            for result in multi_proc(processor, rerun, nr_cpus=len(rerun)):
+                pass
+
+        if path_out == "-":
+            for p in paths:
+                with gzip.open(p, "rb") as f:
+                    copyfileobj(f, sys.stdout.buffer, BATCH_SIZE)
+            sys.stdout.buffer.flush()
+        else:
+            # gzip members can simply be concatenated
+            with open(path_out, "wb") as f_out:
+                for p in paths:
+                    with open(p, "rb") as f:
+                        copyfileobj(f, f_out)
+
+    return categorical_values, stats
+
+
+def process_path(path_in, path_out, force, level, id_attribute, categorical, shards=1, threads=1):
+    """
+
+    :param int threads: (de)compress on this many threads (output is written as BGZF if threads > 1)
+
+    path_out "-" writes uncompressed VRT to stdout (e.g. to pipe it into
+    cwb-encode), status messages then go to stderr
+    """
+
+    if path_out == "-":
+        log = sys.stderr
+    else:
+        log = sys.stdout
+        f_name, path_out = save_path_out(path_in, path_out, suffix='-cqpweb.vrt.gz', force=force)
+
+    start = default_timer()
+    if shards > 1:
+        categorical_values, stats = convert_sharded(path_in, path_out, shards, level, id_attribute, categorical)
+    else:
+        output = nullcontext(sys.stdout.buffer) if path_out == "-" else open_vrt(path_out, "wb", threads=threads, bgzf=threads > 1)
+        with output as f_out:
+            encountered, assigned, categorical_values, stats = convert(
+                iter_path(path_in, threads=threads), f_out, level, id_attribute, categorical
+            )
+            f_out.flush()
 
     for key, values in categorical_values.items():
-        print(f"- {key}: {len(values)} types")
+        print(f"- {key}: {len(values)} types", file=log)
+    report_throughput(stats, default_timer() - start, file=log)
+    if shards == 1:
+        info = force_categorical.cache_info()
+        print(f"force_categorical: {info.hits} cache hits, {info.misses} misses", file=log)
 
 
 def main(args):
@@ -126,4 +278,6 @@ def main(args):
                  args.force,
                  args.level,
                  args.index,
-                 args.categorical)
+                 args.categorical,
+                 args.shards,
+                 args.threads)
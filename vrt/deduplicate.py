@@ -1,39 +1,60 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from functools import partial
 from glob import glob
 from hashlib import md5
-from pandas import DataFrame, NamedAgg
+from numpy import vstack, zeros
+from pandas import DataFrame, NamedAgg, read_csv
+from struct import Struct
+from tempfile import TemporaryDirectory
 from unicodedata import category
 import gzip
+import os
 import re
 
-from vrt.utils import save_path_out
+from vrt.minhash import clusters, permutations, signature
+from vrt.shard import find_shards, iter_shard
+from vrt.store import FingerprintStore
+from vrt.stream import P_ATT, S_CLOSE, S_OPEN, iter_path, open_vrt
+from vrt.utils import merge_files, multi_proc, save_path_out
 from vrt.vrt import meta2dict
 
 
-def replace_urls(text, by='URL'):
+_URL = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+_MENTION = re.compile(r'@\w+')
+_RT = re.compile(r'^RT$')
+_RT_LINES = re.compile(r'^RT$', re.MULTILINE)
 
-    url = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-    text = url.sub(by, text)
 
-    return text
+class _LetterTable(dict):
+    """translation table for str.translate: keeps letters, deletes all other
+    characters; the unicode category of each code point is looked up once
 
+    """
+    def __missing__(self, codepoint):
+        value = codepoint if category(chr(codepoint)).startswith('L') else None
+        self[codepoint] = value
+        return value
 
-def replace_mentions(text, by='@USER'):
 
-    mention = re.compile(r'@\w+')
-    text = mention.sub(by, text)
+_LETTERS = _LetterTable()
+_LETTERS_LINES = _LetterTable({ord("\n"): ord("\n")})
 
-    return text
 
+def replace_urls(text, by='URL'):
 
-def replace_rts(text, by=''):
+    return _URL.sub(by, text)
+
+
+def replace_mentions(text, by='@USER'):
+
+    return _MENTION.sub(by, text)
 
-    rt = re.compile(r'^RT$')
-    text = rt.sub(by, text)
 
-    return text
+def replace_rts(text, by=''):
+
+    return _RT.sub(by, text)
 
 
 def text_normalise(text):
@@ -47,48 +68,96 @@ def text_normalise(text):
     text = replace_urls(text, "")
     text = replace_mentions(text, "")
     text = replace_rts(text, "")
-    text = ''.join([c for c in text if category(c).startswith('L')])
+    text = text.translate(_LETTERS)
     return text.lower()
 
 
-def fingerprint(path_in, level="s", col=0, sep="\t", normalise=True):
+def normalise_tokens(tokens):
+    """text_normalise() for a whole region at once: tokens are joined
+    by line breaks, which none of the patterns match across
+
+    """
+    if len(tokens) == 0:
+        return []
+    text = "\n".join(tokens)
+    text = _URL.sub("", text)
+    text = _MENTION.sub("", text)
+    text = _RT_LINES.sub("", text)
+    text = text.translate(_LETTERS_LINES)
+    return text.lower().split("\n")
+
+
+def fingerprint(path_in, level="s", col=0, sep="\t", normalise=True, shards=1):
     """
     extract fingerprints for each region based on p-atts stored in {col}
+    (processing {shards} shards of the file in parallel)
     """
+
+    shards = find_shards(path_in, level, shards)
+    if len(shards) == 1:
+        return fingerprint_events(iter_path(path_in), path_in, level, col, sep, normalise)
+
+    processor = partial(_fingerprint_shard, path_in=path_in, level=level, col=col, sep=sep, normalise=normalise)
     regions = list()
-    with gzip.open(path_in, "rt") as f:
-
-        region = list()         # lines of current region
-        nr = 0
-        meta = dict()
-
-        for line in f:
-            line = line.strip()
-            if line.startswith(f"<{level}>") or line.startswith(f"<{level} "):
-                meta = meta2dict(line, level=level)
-                meta['path'] = path_in
-
-            if line.startswith(f"</{level}>"):
-                region_fingerprint = {
-                    'region_nr': nr,
-                    'region_length': len(region),
-                    'region_hash': md5(''.join(region).encode()).hexdigest()
-                }
-                regions.append({**meta, **region_fingerprint})
-                region = list()
-                nr += 1
+    for records in multi_proc(processor, shards, nr_cpus=len(shards)):
+        regions.extend(records)
 
-            # p-attribute lines
-            elif not line.startswith("<"):
-                p_att = line.split(sep)[col]
-                if normalise:
-                    p_att = text_normalise(p_att)
-                region.append(p_att)
+    return regions
+
+
+def _fingerprint_shard(shard, path_in, level, col, sep, normalise):
+    """"""
+    return fingerprint_events(iter_shard(path_in, shard), path_in, level, col, sep, normalise, region_nr=shard[2])
+
+
+def iter_regions(events, level="s", col=0, sep="\t", normalise=True):
+    """
+    yield (start tag, p-atts in {col}) for each {level} region of (kind, name, line)-events
+    """
+    region = list()             # p-atts of current region
+    start = None
+
+    for kind, name, line in events:
+
+        # p-attribute lines
+        if kind == P_ATT:
+            region.append(line.decode().strip().split(sep)[col])
+
+        elif name != level:
+            continue
+
+        elif kind == S_OPEN:
+            start = line
+
+        elif kind == S_CLOSE:
+            yield start, normalise_tokens(region) if normalise else region
+            region = list()
+
+
+def fingerprint_events(events, path_in, level="s", col=0, sep="\t", normalise=True, region_nr=0):
+    """
+    extract fingerprints for each region of (kind, name, line)-events of the file at path_in
+
+    :param int region_nr: number of {level} regions before the first event
+    """
+    regions = list()
+    meta = dict()
+
+    for nr, (start, region) in enumerate(iter_regions(events, level, col, sep, normalise), region_nr):
+        if start is not None:
+            meta = meta2dict(start.decode().strip(), level=level)
+            meta['path'] = path_in
+        region_fingerprint = {
+            'region_nr': nr,
+            'region_length': len(region),
+            'region_hash': md5(''.join(region).encode()).hexdigest()
+        }
+        regions.append({**meta, **region_fingerprint})
 
     return regions
 
 
-def detect(records, order=['path', 'region_nr'], keep='last', normalise=True):
+def detect(records, order=['path', 'region_nr'], keep='last', normalise=True, seen=None):
     """
     detect duplicates in records
     return a dataframe containing
@@ -97,6 +166,9 @@ def detect(records, order=['path', 'region_nr'], keep='last', normalise=True):
     - nr_tokens
     - cluster_id
     - dup
+
+    :param DataFrame seen: clusters of previously seen regions (see vrt.store.FingerprintStore.lookup);
+                           their regions are counted and, with keep='first', kept instead
     """
 
     # create dataframe and sort according to id_cols
@@ -113,28 +185,508 @@ def detect(records, order=['path', 'region_nr'], keep='last', normalise=True):
         cluster_id=NamedAgg(column='internal_id', aggfunc=keep)
     ).reset_index()
 
+    if seen is not None and len(seen) > 0:
+        clusters = clusters.merge(seen, how='left', left_on='region_hash', right_index=True, suffixes=('', '_seen'))
+        known = clusters['nr_regions_seen'].notna()
+        clusters.loc[known, 'nr_regions'] += clusters.loc[known, 'nr_regions_seen'].astype(int)
+        clusters.loc[known, 'nr_tokens'] += clusters.loc[known, 'nr_tokens_seen'].astype(int)
+        if keep == 'first':
+            clusters.loc[known, 'cluster_id'] = clusters.loc[known, 'cluster_id_seen']
+            ndup['duplicate'] |= ndup['region_hash'].isin(seen.index)
+        clusters = clusters.drop(['nr_regions_seen', 'nr_tokens_seen', 'cluster_id_seen'], axis=1)
+
     ndup = ndup.merge(clusters, on='region_hash').sort_values(by=order).set_index(order).drop('region_hash', axis=1)
 
     return ndup
 
 
+def signatures(path_in, level="s", col=0, sep="\t", normalise=True, num_perm=128, k=3, shards=1):
+    """
+    extract MinHash signatures of the {k}-shingles of p-atts stored in {col} for each region
+    (processing {shards} shards of the file in parallel)
+
+    :return: records (meta data, region_nr, region_length), array of signatures
+    """
+
+    shards = find_shards(path_in, level, shards)
+    if len(shards) == 1:
+        return signatures_events(iter_path(path_in), path_in, level, col, sep, normalise, num_perm, k)
+
+    processor = partial(_signatures_shard, path_in=path_in, level=level, col=col, sep=sep,
+                        normalise=normalise, num_perm=num_perm, k=k)
+    regions, sigs = list(), list()
+    for records, s in multi_proc(processor, shards, nr_cpus=len(shards)):
+        regions.extend(records)
+        sigs.append(s)
+
+    return regions, vstack(sigs)
+
+
+def _signatures_shard(shard, path_in, level, col, sep, normalise, num_perm, k):
+    """"""
+    return signatures_events(iter_shard(path_in, shard), path_in, level, col, sep, normalise, num_perm, k, region_nr=shard[2])
+
+
+def signatures_events(events, path_in, level="s", col=0, sep="\t", normalise=True, num_perm=128, k=3, region_nr=0):
+    """
+    extract MinHash signatures for each region of (kind, name, line)-events of the file at path_in
+
+    :param int region_nr: number of {level} regions before the first event
+    """
+    perms = permutations(num_perm)
+    regions = list()
+    sigs = list()
+    meta = dict()
+
+    for nr, (start, region) in enumerate(iter_regions(events, level, col, sep, normalise), region_nr):
+        if start is not None:
+            meta = meta2dict(start.decode().strip(), level=level)
+            meta['path'] = path_in
+        regions.append({**meta, 'region_nr': nr, 'region_length': len(region)})
+        sigs.append(signature(region, perms, k))
+
+    return regions, vstack(sigs) if len(sigs) > 0 else zeros((0, num_perm), dtype="uint32")
+
+
+def detect_near(records, sigs, threshold=0.8, order=['path', 'region_nr'], keep='last'):
+    """
+    detect near-duplicates in records with MinHash signatures sigs
+    (regions end up in one cluster if they are connected by pairs of
+    LSH candidates with estimated Jaccard similarity of at least {threshold})
+
+    return a dataframe containing the columns of detect() and
+    - jaccard: estimated Jaccard similarity to the kept region of the cluster
+    """
+
+    if keep not in ('first', 'last'):
+        raise ValueError('keep must be "first" or "last"')
+
+    ndup = DataFrame.from_records(records).sort_values(by=order)
+    sigs = sigs[ndup.index.values]
+    ndup = ndup.reset_index(drop=True)
+
+    groups = ndup.assign(cluster=clusters(sigs, threshold), position=ndup.index).groupby('cluster')
+    kept = groups['position'].transform('min' if keep == 'first' else 'max').values
+
+    ndup['duplicate'] = ndup.index.values != kept
+    ndup['internal_id'] = ndup['path'].astype(str) + '_' + ndup['region_nr'].astype(str)
+    ndup['nr_regions'] = groups['region_length'].transform('count').values
+    ndup['nr_tokens'] = groups['region_length'].transform('sum').values
+    ndup['cluster_id'] = ndup['internal_id'].values[kept]
+    ndup['jaccard'] = (sigs == sigs[kept]).mean(axis=1)
+
+    return ndup.set_index(order)
+
+
+# suffix of deduplicated VRT files (not read as input)
+SUFFIX_FILTERED = ".dedup.vrt.gz"
+
+
+def write_deduplicated(path_in, path_out, level="s", col=0, sep="\t", normalise=True, seen=None, duplicates=None):
+    """
+    stream file at path_in to path_out, skipping duplicate {level} regions; either
+    - seen: set of region hashes encountered so far (updated): keep first region of every hash (one pass)
+    - duplicates: set of numbers of regions to skip (e.g. from the output of detect())
+
+    only the lines of the current region are held in memory
+
+    :return: fingerprint records of all regions (like fingerprint(), if seen is given)
+    """
+
+    records = list()
+    tokens = list()             # p-atts since last region (as in iter_regions)
+    lines = None                # buffered lines of current region
+    nr = 0
+    meta = dict()
+    nr_skipped = 0
+
+    with open_vrt(path_out, "wb") as f_out:
+        for kind, name, line in iter_path(path_in):
+
+            if kind == P_ATT and seen is not None:
+                tokens.append(line.decode().strip().split(sep)[col])
+
+            if name == level and kind == S_OPEN:
+                lines = [line]
+                if seen is not None:
+                    meta = meta2dict(line.decode().strip(), level=level)
+                    meta['path'] = path_in
+
+            elif name == level and kind == S_CLOSE:
+                lines = [] if lines is None else lines
+                lines.append(line)
+                if seen is not None:
+                    region = normalise_tokens(tokens) if normalise else tokens
+                    digest = md5(''.join(region).encode())
+                    records.append({**meta, 'region_nr': nr, 'region_length': len(region), 'region_hash': digest.hexdigest()})
+                    skip = digest.digest() in seen
+                    seen.add(digest.digest())
+                    tokens = list()
+                else:
+                    skip = nr in duplicates
+                if skip:
+                    nr_skipped += 1
+                else:
+                    f_out.write(b"\n".join(lines) + b"\n")
+                lines = None
+                nr += 1
+
+            elif lines is not None:
+                lines.append(line)
+
+            else:
+                f_out.write(line + b"\n")
+
+        # unclosed region at end of file
+        if lines is not None:
+            f_out.write(b"\n".join(lines) + b"\n")
+
+    print(f".. {path_out}: skipped {nr_skipped} of {nr} regions")
+
+    return records
+
+
+def _write_deduplicated(paths, level, duplicates):
+    """"""
+    path_in, path_out = paths
+    write_deduplicated(path_in, path_out, level, duplicates=duplicates.get(path_in, set()))
+
+
+def path_filtered(path_in):
+    """path of the deduplicated VRT file: {name}.dedup.vrt.gz, where name is the file name without .vrt(.gz)"""
+    return re.sub(r"(\.vrt)?(\.gz)?$", "", path_in, count=1) + SUFFIX_FILTERED
+
+
+def check_paths_out(paths_in, paths_out):
+    """refuse to overwrite any input or to write several outputs to the same path"""
+    inputs = {os.path.abspath(p) for p in paths_in}
+    outputs = set()
+    for p in paths_out:
+        p_abs = os.path.abspath(p)
+        if p_abs in inputs:
+            raise ValueError(f'error: output path "{p}" is also an input path')
+        if p_abs in outputs:
+            raise ValueError(f'error: several outputs would be written to "{p}"')
+        outputs.add(p_abs)
+
+
+def read_duplicates(path_table):
+    """numbers of duplicate regions per path from output table of detect()
+
+    :return: dict path → set of region numbers
+    """
+    duplicates = dict()
+    for chunk in read_csv(path_table, sep="\t", usecols=['path', 'region_nr', 'duplicate'], chunksize=1000000):
+        chunk = chunk.loc[chunk['duplicate'].astype(str) == "True"]
+        for path, region_nr in zip(chunk['path'], chunk['region_nr']):
+            duplicates.setdefault(path, set()).add(int(region_nr))
+    return duplicates
+
+
+def filter_paths(paths_filtered, path_table, level, jobs=1):
+    """second pass: write deduplicated VRT files according to output table of detect()"""
+
+    print("writing deduplicated VRT files")
+    duplicates = read_duplicates(path_table) if os.path.exists(path_table) else dict()
+    processor = partial(_write_deduplicated, level=level, duplicates=duplicates)
+    if jobs > 1:
+        list(multi_proc(processor, list(paths_filtered.items()), nr_cpus=jobs))
+    else:
+        for paths in paths_filtered.items():
+            processor(paths)
+
+
+# external-memory mode: fixed-width big-endian records, so that sorting
+# the raw bytes sorts by the fields in order
+FINGERPRINT = Struct(">16sIQI")      # hash (md5 digest), path id, region nr, region length
+RESULT = Struct(">IQI?QQIQ")         # path id, region nr, region length, duplicate,
+#                                      nr_regions, nr_tokens, cluster path id, cluster region nr
+GROUP = Struct(">16sQQIQ")           # hash, nr_regions, nr_tokens, kept path id, kept region nr
+
+# number of records read at once from disk
+READ_RECORDS = 1 << 12
+
+
+def write_records(records, path):
+    """write packed records (from any iterable) to file"""
+    with open(path, "wb") as f:
+        batch = list()
+        for record in records:
+            batch.append(record)
+            if len(batch) >= READ_RECORDS:
+                f.write(b"".join(batch))
+                batch = list()
+        f.write(b"".join(batch))
+
+
+def iter_records(path, size):
+    """yield packed records of fixed {size} from file"""
+    with open(path, "rb") as f:
+        while True:
+            buffer = f.read(size * READ_RECORDS)
+            if not buffer:
+                break
+            for i in range(0, len(buffer), size):
+                yield buffer[i: i + size]
+
+
+def write_runs(records, dir_tmp, run_size, prefix="run"):
+    """sort packed records in runs of at most {run_size} records and spill them to {dir_tmp}
+
+    :return: paths of sorted runs
+    """
+    paths = list()
+    run = list()
+    for record in records:
+        run.append(record)
+        if len(run) >= run_size:
+            paths.append(os.path.join(dir_tmp, f"{prefix}-{len(paths):05d}.bin"))
+            write_records(sorted(run), paths[-1])
+            run = list()
+    if len(run) > 0:
+        paths.append(os.path.join(dir_tmp, f"{prefix}-{len(paths):05d}.bin"))
+        write_records(sorted(run), paths[-1])
+    return paths
+
+
+def merge_runs(paths, size, fan_in=None, prefix="merge"):
+    """yield packed records of sorted runs in sorted order (with at most {fan_in} open runs, see merge_files)"""
+    return merge_files(paths, partial(iter_records, size=size), write_records, fan_in, prefix)
+
+
+def sort_records(records, size, dir_tmp, run_size, prefix="run"):
+    """external sort of packed records of fixed {size}"""
+    return merge_runs(write_runs(records, dir_tmp, run_size, prefix), size, prefix=f"{prefix}-merge")
+
+
+def spill_fingerprints(item, level, col, sep, normalise, dir_tmp, run_size):
+    """fingerprint one shard of one file and spill sorted runs of FINGERPRINT records
+
+    :param tuple item: (path id, path, shard)
+    :return: paths of sorted runs
+    """
+    path_id, path_in, shard = item
+    start, end, region_nr = shard
+    records = (
+        FINGERPRINT.pack(md5(''.join(region).encode()).digest(), path_id, nr, len(region))
+        for nr, (tag, region) in enumerate(iter_regions(iter_shard(path_in, shard), level, col, sep, normalise), region_nr)
+    )
+    return write_runs(records, dir_tmp, run_size, prefix=f"fp-{path_id:05d}-{start:012d}")
+
+
+def _iter_groups(records, keep):
+    """yield GROUP records for sorted FINGERPRINT records"""
+    group = None
+    for record in records:
+        region_hash, path_id, nr, length = FINGERPRINT.unpack(record)
+        if group is None or group[0] != region_hash:
+            if group is not None:
+                yield GROUP.pack(*group)
+            group = [region_hash, 0, 0, path_id, nr]
+        group[1] += 1
+        group[2] += length
+        if keep == 'last':
+            group[3:5] = path_id, nr
+    if group is not None:
+        yield GROUP.pack(*group)
+
+
+def _iter_results(records, groups):
+    """yield RESULT records: merge-join sorted FINGERPRINT and GROUP records on hash"""
+    region_hash = None
+    for record in records:
+        h, path_id, nr, length = FINGERPRINT.unpack(record)
+        if h != region_hash:
+            region_hash, nr_regions, nr_tokens, kept_path_id, kept_nr = GROUP.unpack(next(groups))
+        duplicate = (path_id, nr) != (kept_path_id, kept_nr)
+        yield RESULT.pack(path_id, nr, length, duplicate, nr_regions, nr_tokens, kept_path_id, kept_nr)
+
+
+def detect_external(paths_runs, paths_in, path_out, dir_tmp, keep='last', run_size=1000000):
+    """
+    detect duplicates in sorted runs of FINGERPRINT records without holding them in memory;
+    write the same table as detect() (without meta data of the regions) to path_out
+
+    :return: number of (non-)duplicates
+    """
+
+    if keep not in ('first', 'last'):
+        raise ValueError('keep must be "first" or "last"')
+
+    # one merged, hash-sorted file: read twice (group statistics, results)
+    path_sorted = os.path.join(dir_tmp, "sorted.bin")
+    write_records(merge_runs(paths_runs, FINGERPRINT.size), path_sorted)
+    for p in paths_runs:
+        os.remove(p)
+
+    path_groups = os.path.join(dir_tmp, "groups.bin")
+    write_records(_iter_groups(iter_records(path_sorted, FINGERPRINT.size), keep), path_groups)
+
+    results = _iter_results(iter_records(path_sorted, FINGERPRINT.size), iter_records(path_groups, GROUP.size))
+    results = sort_records(results, RESULT.size, dir_tmp, run_size, prefix="result")
+
+    stats = {False: 0, True: 0}
+    with gzip.open(path_out, "wt") as f:
+        f.write("\t".join(['path', 'region_nr', 'region_length', 'duplicate', 'internal_id',
+                           'nr_regions', 'nr_tokens', 'cluster_id']) + "\n")
+        for record in results:
+            path_id, nr, length, duplicate, nr_regions, nr_tokens, kept_path_id, kept_nr = RESULT.unpack(record)
+            path_in = paths_in[path_id]
+            f.write(f"{path_in}\t{nr}\t{length}\t{duplicate}\t{path_in}_{nr}\t"
+                    f"{nr_regions}\t{nr_tokens}\t{paths_in[kept_path_id]}_{kept_nr}\n")
+            stats[duplicate] += 1
+
+    return stats
+
+
 def main(args):
 
-    paths_in = glob(args.glob_in)
+    # deduplicated files of previous runs
+    paths_in = sorted(p for p in glob(args.glob_in) if not p.endswith(SUFFIX_FILTERED))
     f_name, path_out = save_path_out(paths_in[0], args.path_out, suffix='.dup.gz', force=args.force)
 
+    shards = args.shards
+    if args.jobs > 1 and shards > 1:
+        print("warning: processing files in parallel, ignoring --shards")
+        shards = 1
+
+    if args.store is not None and (args.near is not None or args.external):
+        print("warning: the fingerprint store is only used for exact in-memory deduplication, ignoring --store")
+
+    paths_filtered = dict()
+    if args.filter:
+        paths_filtered = {p: path_filtered(p) for p in paths_in}
+    check_paths_out(paths_in, [path_out] + list(paths_filtered.values()))
+    for p in paths_filtered.values():
+        save_path_out(p, p, force=args.force)
+
+    if args.near is not None:
+        if args.external:
+            print("warning: near-duplicate detection is not available in external-memory mode, ignoring --external")
+        main_near(args, paths_in, path_out, shards)
+        if args.filter:
+            filter_paths(paths_filtered, path_out, args.level, args.jobs)
+        return
+
+    if args.external:
+        main_external(args, paths_in, path_out, shards)
+        if args.filter:
+            filter_paths(paths_filtered, path_out, args.level, args.jobs)
+        return
+
+    store = None
+    if args.store is not None:
+        store = FingerprintStore(args.store)
+        paths_new = list()
+        for p in paths_in:
+            status = store.status(p)
+            if status == "known":
+                print(f".. skipping {p} (already in fingerprint store)")
+                continue
+            if status == "changed":
+                print(f"warning: {p} has changed since it was added to the fingerprint store, replacing its fingerprints")
+                store.remove(p)
+            paths_new.append(p)
+        paths_in = paths_new
+        paths_filtered = {p: paths_filtered[p] for p in paths_in if p in paths_filtered}
+        if len(paths_in) == 0:
+            print("no new files, nothing to do")
+            store.close()
+            return
+
+    # keep='first' can be decided while reading (unless the store knows earlier regions)
+    single_pass = args.filter and args.keep == 'first' and store is None
+
     print("collecting fingerprints")
+    processor = partial(fingerprint, level=args.level, col=0, sep="\t", normalise=args.normalise, shards=shards)
     region_records = list()
-    for p in paths_in:
-        print(".. " + p)
-        region_records.extend(fingerprint(p, args.level, col=0, sep="\t", normalise=args.normalise))
+    if single_pass:
+        print(".. writing deduplicated VRT files in the same pass")
+        hashes = set()
+        for p in paths_in:
+            print(".. " + p)
+            region_records.extend(write_deduplicated(p, paths_filtered[p], args.level, normalise=args.normalise, seen=hashes))
+    elif args.jobs > 1:
+        for records in multi_proc(processor, paths_in, nr_cpus=args.jobs):
+            region_records.extend(records)
+    else:
+        for p in paths_in:
+            print(".. " + p)
+            region_records.extend(processor(p))
 
     if len(region_records) == 0:
         print(f"can't find any '{args.level}' regions, aborting")
 
     else:
+        seen = None
+        if store is not None:
+            print("checking fingerprint store")
+            seen = store.lookup({r['region_hash'] for r in region_records})
+            print(f".. {len(seen)} of the fingerprints have been seen before")
+        print("detecting duplicates")
+        ndup = detect(region_records, keep=args.keep, seen=seen)
+        print(".. stats:")
+        print(ndup['duplicate'].value_counts())
+        ndup.to_csv(path_out, sep="\t", compression="gzip")
+
+    if args.filter and not single_pass:
+        filter_paths(paths_filtered, path_out, args.level, args.jobs)
+
+    if store is not None:
+        print("updating fingerprint store")
+        store.add(region_records, paths_in)
+        store.close()
+
+
+def main_external(args, paths_in, path_out, shards):
+    """external-memory mode: spill fingerprints to disk, sort and merge them there"""
+
+    items = [(path_id, p, shard) for path_id, p in enumerate(paths_in) for shard in find_shards(p, args.level, shards)]
+    with TemporaryDirectory(dir=args.tmp_dir) as dir_tmp:
+
+        print("collecting fingerprints")
+        processor = partial(spill_fingerprints, level=args.level, col=0, sep="\t", normalise=args.normalise,
+                            dir_tmp=dir_tmp, run_size=args.run_size)
+        nr_cpus = max(args.jobs, shards)
+        paths_runs = list()
+        if nr_cpus > 1:
+            for runs in multi_proc(processor, items, nr_cpus=nr_cpus):
+                paths_runs.extend(runs)
+        else:
+            for item in items:
+                print(".. " + item[1])
+                paths_runs.extend(processor(item))
+
         print("detecting duplicates")
-        ndup = detect(region_records, keep=args.keep)
+        stats = detect_external(paths_runs, paths_in, path_out, dir_tmp, keep=args.keep, run_size=args.run_size)
+
+    if stats[False] + stats[True] == 0:
+        print(f"can't find any '{args.level}' regions")
+    print(".. stats:")
+    print(f"duplicate: {stats[True]}, not duplicate: {stats[False]}")
+
+
+def main_near(args, paths_in, path_out, shards):
+    """near-duplicate mode: MinHash signatures and LSH"""
+
+    print("collecting signatures")
+    processor = partial(signatures, level=args.level, col=0, sep="\t", normalise=args.normalise,
+                        num_perm=args.num_perm, k=args.shingle, shards=shards)
+    region_records, sigs = list(), list()
+    if args.jobs > 1:
+        results = multi_proc(processor, paths_in, nr_cpus=args.jobs)
+    else:
+        results = map(processor, paths_in)
+    for records, s in results:
+        region_records.extend(records)
+        sigs.append(s)
+
+    if len(region_records) == 0:
+        print(f"can't find any '{args.level}' regions, aborting")
+
+    else:
+        print("detecting near-duplicates")
+        ndup = detect_near(region_records, vstack(sigs), threshold=args.near, keep=args.keep)
         print(".. stats:")
         print(ndup['duplicate'].value_counts())
         ndup.to_csv(path_out, sep="\t", compression="gzip")
@@ -1,23 +1,68 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import gzip
+import io
 import os
+import re
+import signal
+import subprocess
+import sys
 import xml
 from collections import defaultdict
-
-from vrt.utils import Progress, is_gz_file, save_path_out
+from functools import partial
+
+from vrt.bgzf import BLOCK_SIZE as BGZF_BLOCK_SIZE
+from vrt.bgzf import load_index
+from vrt.offsets import process_path as process_offsets
+from vrt.shard import ShardReader, is_seekable, write_parts
+from vrt.stream import P_ATT, S_OPEN, iter_events, iter_path
+from vrt.utils import Progress, is_gz_file, multi_proc, save_path_out
 from vrt.vrt import meta2dict
 
 
-def create_file(path_in, corpus_name, registry_dir, data_dir, p_atts, s_atts, lemmatisation=False, charset="utf8"):
+def available_memory(default=4096):
+    """memory available (MB) according to /proc/meminfo (or the number of physical pages)"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES") // 2 ** 20
+    except (ValueError, OSError, AttributeError):
+        return default
+
+
+def memory_per_job(jobs, share=0.75, minimum=256):
+    """memory limit (MB) for cwb-make when running {jobs} encoding jobs concurrently"""
+    return max(minimum, int(available_memory() * share / jobs))
+
+
+def path_lemmatised(path_in):
+    """{name}-lemma.vrt next to path_in, where name is the file name without .vrt(.gz) / .gz"""
+    path_out = re.sub(r"(\.vrt)?(\.gz)?$", "", path_in, count=1) + "-lemma.vrt"
+    assert path_out != path_in
+    return path_out
+
+
+def create_file(path_in, corpus_name, registry_dir, data_dir, p_atts, s_atts, lemmatisation=False, charset="utf8", memory=4096,
+                pipe=False, input_command=None):
     """
     create shell script for executing cwb-encode
     with default options:
     global: -xsBC -9
     s-attributes: -S {s}:0 or -S {s}:0+..., <corpus> will be ignored
+
+    with pipe=True, cwb-encode reads from stdin: the output of
+    {input_command} (e.g. "vrt-cqpweb ... -o -") or of pigz / gzip
+    decompressing path_in; the lemmatised export is piped into pigz /
+    gzip, so no uncompressed intermediate files are written
     """
 
+    pipe = pipe or input_command is not None
+
     lines = [
         '#!/bin/bash',
         '',
@@ -38,13 +83,49 @@ def create_file(path_in, corpus_name, registry_dir, data_dir, p_atts, s_atts, le
         f'cwb-encode -d $data_subdir -f $path_in -R "$registry_file" -xsBC -c {charset} -9 {p_atts} {s_atts}',
         '',
         'echo "cwb-make"',
-        'cwb-make -r $registry_dir -M 4096 -V "$corpus_name"',
+        f'cwb-make -r $registry_dir -M {memory} -V "$corpus_name"',
         ''
     ]
 
-    if lemmatisation:
+    if pipe:
+
+        if input_command is None:
+            input_command = '$decompress "$path_in"' if path_in.endswith(".gz") else 'cat "$path_in"'
+
+        i = lines.index('echo "cwb-encode (registry file: $registry_file)"')
+        lines[i + 1] = f'{input_command} | cwb-encode -d $data_subdir -R "$registry_file" -xsBC -c {charset} -9 {p_atts} {s_atts} || exit 1'
+        lines[i: i] = [
+            '# use parallel (de)compression if available',
+            'compress="gzip -c"',
+            'decompress="gzip -dc"',
+            'if command -v pigz > /dev/null; then',
+            '    compress="pigz -c"',
+            '    decompress="pigz -dc"',
+            'fi',
+            'set -o pipefail',
+            ''
+        ]
+
+    if lemmatisation and pipe:
 
-        path_out = path_in.replace(".vrt.gz", "-lemma.vrt")
+        path_out = path_lemmatised(path_in) + ".gz"
+
+        # explicitly export p-att 'word' and 'lemma' alongside all other p-atts
+        p_atts = " ".join(["-P word", p_atts, "-P lemma"])
+
+        lines += [
+            'echo "lemmatisation"',
+            'cwb-lemmatize-smor -E -T $corpus_name',
+            '',
+            'echo "export and compression"',
+            f'file_out="{path_out}"',
+            f'cwb-decode -Cx $corpus_name {p_atts} {s_atts} | $compress > $file_out',
+            ''
+        ]
+
+    elif lemmatisation:
+
+        path_out = path_lemmatised(path_in)
 
         # explicitly export p-att 'word' and 'lemma' alongside all other p-atts
         p_atts = " ".join(["-P word", p_atts, "-P lemma"])
@@ -65,64 +146,272 @@ def create_file(path_in, corpus_name, registry_dir, data_dir, p_atts, s_atts, le
     return "\n".join(lines)
 
 
-def guess_attributes(path_in, cut_off, ignore_corpus=False):
+# quoted attribute values: removing them leaves the signature of an s-attribute line
+_QUOTED = re.compile(rb'"[^"]*"|\'[^\']*\'')
+
+# sampling: size of blocks (uncompressed bytes)
+SAMPLE_SIZE = 1 << 20
+
+# number of lines between progress updates
+PROGRESS_STEP = 10000
+
+
+def new_schema():
     """"""
+    return {
+        's_atts': dict(),           # name -> set of annotations (in order of appearance)
+        's_counts': defaultdict(int),
+        'signatures': dict(),       # signature -> (name, annotations)
+        'nr_p_atts': 1,
+        'nr_p_lines': 0,
+        'nr_s_lines': 0,
+        'nr_lines': 0,
+        'nr_bytes': 0
+    }
 
-    print(f"guessing attributes from first {cut_off} lines...")
 
-    s_atts = defaultdict(set)
-    nr_p_atts = 1
-    nr_p_lines = 0
-    nr_s_lines = 0
+def scan_schema(events, schema=None, cut_off=0, pb=None):
+    """collect s-attributes (with annotations), number of p-attributes and
+    line statistics from (kind, name, line)-events
 
-    f = gzip.open(path_in, "rt") if is_gz_file(path_in) else open(path_in, "rt")
-    pb = Progress(length=cut_off) if cut_off > 0 else Progress()
-    for line in f:
+    every s-attribute signature (line without attribute values) is only parsed once
 
-        if line.startswith("<?") or line.startswith("<!"):
-            # xml declaration or comment
-            continue
+    """
+
+    schema = new_schema() if schema is None else schema
+    s_atts = schema['s_atts']
+    s_counts = schema['s_counts']
+    signatures = schema['signatures']
+    nr_p_atts = schema['nr_p_atts']
+    nr_p_lines = nr_s_lines = nr_lines = nr_bytes = 0
+
+    for kind, name, line in events:
 
-        elif line.startswith("<") and not line.startswith("</"):
+        nr_lines += 1
+        nr_bytes += len(line) + 1
+
+        if kind == S_OPEN:
             # s-atts
             nr_s_lines += 1
-            typ, ann = parse_s_att(line)
-            s_atts[typ] = s_atts[typ].union(ann)
-
-        else:
+            signature = _QUOTED.sub(b"", line)
+            parsed = signatures.get(signature)
+            if parsed is None:
+                try:
+                    parsed = signatures[signature] = parse_s_att(line.decode())
+                except xml.etree.ElementTree.ParseError:
+                    # not cached: other lines with this signature may be valid
+                    print("error when parsing s-attribute:")
+                    print(line.decode())
+                    parsed = (name, set())
+            typ, ann = parsed
+            s_counts[typ] += 1
+            if typ not in s_atts:
+                s_atts[typ] = set()
+            s_atts[typ].update(ann)
+
+        elif kind == P_ATT:
             # p-atts
             nr_p_lines += 1
-            nr_p_atts = max(nr_p_atts, len(line.split("\t")))
+            nr_p_atts = max(nr_p_atts, line.count(b"\t") + 1)
 
-        pb.up()
-        if cut_off > 0 and pb.c >= cut_off:
+        # xml declarations, comments and closing tags carry no attributes
+
+        if pb is not None and nr_lines % PROGRESS_STEP == 0:
+            pb.c += PROGRESS_STEP - 1
+            pb.up()
+        if cut_off > 0 and nr_lines >= cut_off:
             break
 
-    if cut_off <= 0 or pb.c < pb.length:
-        pb.fine()
+    if pb is not None:
+        pb.c = schema['nr_lines'] + nr_lines
+    schema['nr_p_atts'] = nr_p_atts
+    schema['nr_p_lines'] += nr_p_lines
+    schema['nr_s_lines'] += nr_s_lines
+    schema['nr_lines'] += nr_lines
+    schema['nr_bytes'] += nr_bytes
+
+    return schema
 
-    f.close()
+
+def merge_schemas(schemas):
+    """"""
+    merged = new_schema()
+    for schema in schemas:
+        for typ, ann in schema['s_atts'].items():
+            merged['s_atts'].setdefault(typ, set()).update(ann)
+        for typ, count in schema['s_counts'].items():
+            merged['s_counts'][typ] += count
+        merged['signatures'].update(schema['signatures'])
+        merged['nr_p_atts'] = max(merged['nr_p_atts'], schema['nr_p_atts'])
+        for key in ['nr_p_lines', 'nr_s_lines', 'nr_lines', 'nr_bytes']:
+            merged[key] += schema[key]
+    return merged
+
+
+def sample_offsets(path, nr_samples, sample_size):
+    """uncompressed start offsets of {nr_samples} blocks spread across the
+    (plain or BGZF) file, or None if sampling would read (almost) everything
+
+    """
+
+    if is_gz_file(path):
+        # every worker seeks via the block index
+        index = load_index(path, write=True)
+        if len(index) * BGZF_BLOCK_SIZE <= nr_samples * sample_size:
+            return None
+        return sorted({index[i * len(index) // nr_samples][1] for i in range(nr_samples)})
+
+    size = os.path.getsize(path)
+    if size <= nr_samples * sample_size:
+        return None
+    return [i * size // nr_samples for i in range(nr_samples)]
+
+
+def _scan_sample(start, path, sample_size):
+    """scan complete lines of block [start, start + sample_size)"""
+
+    with ShardReader(path, start, start + sample_size) as f:
+        data = f.read()
+
+    # only use complete lines
+    begin = 0 if start == 0 else data.find(b"\n") + 1
+    end = data.rfind(b"\n") + 1
+    if begin == 0 and start > 0 or end <= begin:
+        return new_schema()
+
+    return scan_schema(iter_events(io.BytesIO(data[begin: end])))
+
+
+def create_file_parts(paths_parts, corpus_name, registry_dir, data_dir, p_atts, s_atts, jobs, memory, charset="utf8"):
+    """
+    create shell script for encoding parts of a corpus (see
+    vrt.shard.write_parts) as sub-corpora {corpus_name}_1, ... on {jobs}
+    processes (same options as create_file); each cwb-make may use {memory} MB
+
+    CWB cannot merge indexed corpora, so every part remains a corpus of its
+    own (which also keeps each below CWB's limit of 2^31 tokens)
+    """
+
+    width = len(str(len(paths_parts)))
+    parts = " ".join(f"{nr + 1:0{width}d}" for nr in range(len(paths_parts)))
+    dir_parts = os.path.dirname(paths_parts[0])
+
+    lines = [
+        '#!/bin/bash',
+        '',
+        f'parts_dir="{dir_parts}"',
+        '',
+        f'corpus_name="{corpus_name}"',
+        '',
+        f'registry_dir="{registry_dir}"',
+        f'data_dir="{data_dir}"',
+        '',
+        f'jobs={jobs}',
+        f'memory={memory}',
+        '',
+        'encode_part() {',
+        '    part_name="${corpus_name}_$1"',
+        '    registry_file="$registry_dir${part_name,,}"',
+        '    data_subdir="$data_dir${part_name,,}"',
+        '    mkdir -p $data_subdir',
+        '    echo "cwb-encode $part_name (registry file: $registry_file)"',
+        f'    cwb-encode -d $data_subdir -f "$parts_dir/part-$1.vrt.gz" -R "$registry_file" -xsBC -c {charset} -9 {p_atts} {s_atts} || return 1',
+        '    echo "cwb-make $part_name"',
+        '    cwb-make -r $registry_dir -M $memory -V "$part_name"',
+        '}',
+        'export -f encode_part',
+        'export parts_dir corpus_name registry_dir data_dir memory',
+        '',
+        f'echo "encoding {len(paths_parts)} sub-corpora on $jobs processes"',
+        f'printf "%s\\n" {parts} | xargs -P $jobs -I {{}} bash -c \'encode_part {{}}\' || exit 1',
+        '',
+        '# CWB cannot merge indexed corpora: every part is a corpus of its own',
+        'echo "sub-corpora registered in $registry_dir:"',
+        f'for part in {parts}; do echo "${{corpus_name}}_$part"; done',
+        ''
+    ]
+
+    return "\n".join(lines)
+
+
+def guess_attributes(path_in, cut_off, ignore_corpus=False, sample=0, sample_size=SAMPLE_SIZE, jobs=1, command=None):
+    """guess attributes from the first {cut_off} lines, or from {sample}
+    blocks of {sample_size} bytes spread across the whole file
+
+    with a shell {command}, attributes are guessed from the first {cut_off}
+    lines of its output instead of path_in (the command is stopped afterwards)
+
+    """
+
+    offsets = None
+    if command is not None:
+        if cut_off <= 0:
+            raise ValueError("error: attributes can only be guessed from the first cut_off > 0 lines of an input command")
+        sample = 0
+    if sample > 0:
+        if is_seekable(path_in):
+            offsets = sample_offsets(path_in, sample, sample_size)
+            if offsets is None:
+                print("file is small, scanning all of it")
+                cut_off = 0
+        else:
+            print(f"warning: file is not seekable (plain gzip), guessing from the first {cut_off} lines instead of sampling "
+                  "(convert to BGZF to enable sampling)", file=sys.stderr)
+
+    if offsets is not None:
+        print(f"guessing attributes from {len(offsets)} blocks of {sample_size} bytes on {jobs} process(es)...")
+        processor = partial(_scan_sample, path=path_in, sample_size=sample_size)
+        pb = Progress(length=len(offsets))
+        schemas = list()
+        for schema in multi_proc(processor, offsets, nr_cpus=jobs):
+            schemas.append(schema)
+            pb.up()
+        schema = merge_schemas(schemas)
+
+    elif command is not None:
+        print(f'guessing attributes from first {cut_off} lines of output of "{command}"...')
+        # own process group: stopping it stops every process of the pipeline, not only the shell
+        with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, start_new_session=True) as proc:
+            try:
+                schema = scan_schema(iter_events(proc.stdout), cut_off=cut_off)
+            finally:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    else:
+        print(f"guessing attributes from first {cut_off} lines..." if cut_off > 0 else "guessing attributes from all lines...")
+        pb = Progress(length=cut_off) if cut_off > 0 else Progress()
+        schema = scan_schema(iter_path(path_in), cut_off=cut_off, pb=pb)
+        if cut_off <= 0 or pb.c < pb.length:
+            pb.fine()
 
     # post-process s-attributes
     s_atts_new = list()
-    for s in s_atts.keys():
+    for s, ann in schema['s_atts'].items():
 
         if ignore_corpus and s == 'corpus':       # ignore <corpus>
             continue
 
-        if len(s_atts[s]) == 0:  # no annotation
+        if len(ann) == 0:       # no annotation
             new = s + ":0"
             s_atts_new.append(new)
-        else:                    # annotation
-            new = s + ":0+" + "+".join(sorted(list(s_atts[s])))
+        else:                   # annotation
+            new = s + ":0+" + "+".join(sorted(list(ann)))
             s_atts_new.append(new)
 
-    print(f"... saw {nr_p_lines} p-attribute lines and {nr_s_lines} s-attribute lines")
-    print(f"... guessed {nr_p_atts} p-attributes and {len(s_atts)} s-attributes")
+    print(f"... saw {schema['nr_lines']} lines ({schema['nr_bytes'] / 2 ** 20:.1f} MB): "
+          f"{schema['nr_p_lines']} p-attribute lines and {schema['nr_s_lines']} s-attribute lines "
+          f"with {len(schema['signatures'])} different signatures")
+    for s, count in schema['s_counts'].items():
+        print(f"    <{s}>: {count}")
+    print(f"... guessed {schema['nr_p_atts']} p-attributes and {len(schema['s_atts'])} s-attributes")
 
     return {
         's_atts': s_atts_new,
-        'nr_p_atts': nr_p_atts
+        'nr_p_atts': schema['nr_p_atts'],
+        'stats': {key: schema[key] for key in ['nr_lines', 'nr_bytes', 'nr_p_lines', 'nr_s_lines']}
     }
 
 
@@ -132,16 +421,21 @@ def parse_s_att(line):
     row = line.strip().rstrip(">").lstrip("<")
     typ = row.split(" ")[0]
 
-    try:
-        ann = set(meta2dict(line, level=typ).keys())
-    except xml.etree.ElementTree.ParseError:
-        print("error when parsing s-attribute:")
-        print(line)
+    # raises xml.etree.ElementTree.ParseError for invalid lines
+    ann = set(meta2dict(line, level=typ).keys())
     return typ, ann
 
 
-def process_path(path_in, path_out, force, name, p_atts, cut_off, data_dir, registry_dir, lemmatisation):
-    """"""
+def process_path(path_in, path_out, force, name, p_atts, cut_off, data_dir, registry_dir, lemmatisation,
+                 sample=0, sample_size=SAMPLE_SIZE, jobs=1, parts=1, level="text", memory=None,
+                 pipe=False, input_command=None):
+    """
+
+    :param int parts: split file at {level} regions into this many sub-corpora encoded on {jobs} processes
+    :param int memory: memory limit of cwb-make (MB) [4096; with parts: derived from available memory]
+    :param bool pipe: stream input into cwb-encode (and lemmatised output into the compressor)
+    :param str input_command: shell command whose output is streamed into cwb-encode (implies pipe)
+    """
 
     # path_in
     f_name, path_out = save_path_out(path_in, path_out, suffix='.sh', force=force)
@@ -150,7 +444,7 @@ def process_path(path_in, path_out, force, name, p_atts, cut_off, data_dir, regi
     corpus_name = f_name.upper() if name is None else name.upper()
 
     # attributes
-    atts = guess_attributes(path_in, cut_off)
+    atts = guess_attributes(path_in, cut_off, sample=sample, sample_size=sample_size, jobs=jobs, command=input_command)
 
     # post-process positional attributes
     if atts['nr_p_atts'] > len(p_atts) + 1:
@@ -165,7 +459,21 @@ def process_path(path_in, path_out, force, name, p_atts, cut_off, data_dir, regi
     print(f"s-attributes: {s_atts}")
 
     # create file contents
-    file_contents = create_file(path_in, corpus_name, registry_dir, data_dir, p_atts, s_atts, lemmatisation)
+    if parts > 1:
+        if lemmatisation:
+            print("warning: lemmatisation is not supported for sub-corpora, skipping it")
+        if pipe or input_command is not None:
+            print("warning: parts are read by cwb-encode directly, ignoring pipe and input command")
+        dir_parts = path_out[:-3] + "-parts" if path_out.endswith(".sh") else path_out + "-parts"
+        print(f"splitting into {parts} parts in {dir_parts}")
+        paths_parts = write_parts(path_in, dir_parts, level, parts, jobs=jobs)
+        memory = memory_per_job(min(jobs, len(paths_parts))) if memory is None else memory
+        print(f"memory per cwb-make: {memory} MB")
+        file_contents = create_file_parts(paths_parts, corpus_name, registry_dir, data_dir, p_atts, s_atts, jobs, memory)
+    else:
+        memory = 4096 if memory is None else memory
+        file_contents = create_file(path_in, corpus_name, registry_dir, data_dir, p_atts, s_atts, lemmatisation, memory=memory,
+                                    pipe=pipe, input_command=input_command)
 
     # write
     with open(path_out, "wt") as f:
@@ -181,6 +489,14 @@ def process_path(path_in, path_out, force, name, p_atts, cut_off, data_dir, regi
 def main(args):
     """"""
 
+    if args.offsets is not None:
+        process_offsets(args.path_in,
+                        args.path_out,
+                        args.force,
+                        args.offsets,
+                        args.index)
+        return
+
     process_path(args.path_in,
                  args.path_out,
                  args.force,
@@ -189,4 +505,12 @@ def main(args):
                  args.cut_off,
                  args.data_dir,
                  args.registry_dir,
-                 args.lemmatisation)
+                 args.lemmatisation,
+                 args.sample,
+                 args.sample_size * 2 ** 20,
+                 args.jobs,
+                 args.parts,
+                 args.level,
+                 args.memory,
+                 args.pipe,
+                 args.input_command)
@@ -2,28 +2,38 @@
 # -*- coding: utf-8 -*-
 
 import gzip
+import os
+from functools import partial
 from glob import glob
 
-from pandas import NamedAgg, concat, read_csv
+from pandas import NamedAgg, Series, concat, read_csv
 
-from vrt.utils import Progress, save_path_out
+from vrt.bgzf import EOF_BLOCK, build_index, compress_block, is_bgzf_file, write_index
+from vrt.stream import open_vrt
+from vrt.utils import Progress, is_gz_file, multi_proc, save_path_out
 from vrt.vrt import dict2meta
 
 
-def read_cohorts_info(paths_info, sep="\t"):
+def read_cohorts_info(paths_info, sep="\t", jobs=1):
     """
     obligatory column in each dataframe: cohort_idx
+
+    files are read on {jobs} processes, columns are categorical
     """
 
     print("gathering cohorts information")
-    pb = Progress(length=len(paths_info), rate=1)
-    dfs = list()
-    for p in paths_info:
-        dfs.append(read_csv(p, sep=sep, dtype=str))
-        pb.up()
+    reader = partial(read_csv, sep=sep, dtype=str)
+    if jobs > 1:
+        dfs = list(multi_proc(reader, paths_info, nr_cpus=jobs))
+    else:
+        pb = Progress(length=len(paths_info), rate=1)
+        dfs = list()
+        for p in paths_info:
+            dfs.append(reader(p))
+            pb.up()
 
     print("concatenating")
-    df = concat(dfs)
+    df = concat(dfs, ignore_index=True)
     df = df.fillna("")
 
     print("deduplicating")
@@ -31,45 +41,108 @@ def read_cohorts_info(paths_info, sep="\t"):
     if 'counts' in df.columns:
         columns.remove('counts')
         df['counts'] = df['counts'].astype(int)
-        df = df.groupby(columns).agg(
-            counts=NamedAgg(column='counts', aggfunc=sum)
+        df[columns] = df[columns].astype('category')
+        df = df.groupby(columns, observed=True).agg(
+            counts=NamedAgg(column='counts', aggfunc='sum')
         )
         df = df.reset_index()
     else:
         df = df.drop_duplicates()
+        df = df.astype('category')
 
     return df.set_index("cohort_idx")
 
 
-def write_cohorts(paths_in, path_out, corpus_name, meta, level='text'):
+def add_paths(meta, paths_in):
+    """add column path: file of each cohort is named {cohort_idx}.vrt.gz;
+    cohorts without file are dropped
+
+    """
+    paths = Series(paths_in, index=[p.split("/")[-1].split(".vrt.gz")[0] for p in paths_in])
+    paths = paths[~paths.index.duplicated(keep='last')]
+    meta = meta.assign(path=meta.index.astype(str).map(paths))
+    missing = meta['path'].isna()
+    if missing.any():
+        print(f"warning: no files for {missing.sum()} cohort(s), skipping them")
+        meta = meta.loc[~missing]
+    return meta
+
+
+def _copy_compressed(path, f_out, bgzf=False):
+    """copy compressed bytes of path verbatim (without trailing BGZF EOF block)"""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if bgzf and size >= len(EOF_BLOCK):
+            f.seek(size - len(EOF_BLOCK))
+            if f.read() == EOF_BLOCK:
+                size -= len(EOF_BLOCK)
+            f.seek(0)
+        while size > 0:
+            chunk = f.read(min(size, 1 << 24))
+            if not chunk:
+                break
+            f_out.write(chunk)
+            size -= len(chunk)
+
+
+def _items(paths_in, meta, level):
+    """(opening tag or None, path) of all files to merge"""
+    if meta is not None:
+        items = list()
+        for m in meta.to_dict(orient='records'):
+            path = m.pop('path')
+            items.append((dict2meta(m, level=level), path))
+        return items
+    return [(None, path) for path in sorted(paths_in)]
+
+
+def write_cohorts(paths_in, path_out, corpus_name, meta, level='text', bgzf=False, threads=1, recompress=False):
     """
     obligatory column in meta: path, id
+
+    if possible, compressed input is copied verbatim between gzip members
+    containing the wrapper tags (multi-member gzip; BGZF if all inputs are
+    BGZF); use recompress=True to decompress and recompress everything
     """
 
+    items = _items(paths_in, meta, level)
+
+    can_copy = is_bgzf_file if bgzf else is_gz_file
+    if not recompress and path_out.endswith(".gz") and all(can_copy(path) for start, path in items):
+        print("writing cohorts (copying compressed input)")
+        compress = compress_block if bgzf else gzip.compress
+        pb = Progress(length=len(items), rate=1)
+        with open(path_out, "wb") as f_out:
+            f_out.write(compress(f'<corpus name="{corpus_name}">\n'.encode()))
+            for start, path in items:
+                if start is not None:
+                    f_out.write(compress(start.encode()))
+                _copy_compressed(path, f_out, bgzf)
+                if start is not None:
+                    f_out.write(compress(f"</{level}>\n".encode()))
+                pb.up()
+            f_out.write(compress(b"</corpus>\n"))
+            if bgzf:
+                f_out.write(EOF_BLOCK)
+        if bgzf:
+            write_index(path_out + ".gzi", build_index(path_out))
+        return
+
     # loop through files and write
     print("writing cohorts")
-    with gzip.open(path_out, "wt") as f_out:
+    pb = Progress(length=len(items), rate=1)
+    with open_vrt(path_out, "wt", threads=threads, bgzf=bgzf) as f_out:
 
         f_out.write(f'<corpus name="{corpus_name}">\n')
-
-        if meta:
-            pb = Progress(length=len(meta), rate=1)
-            for row in meta.iterrows():
-                m = dict(row[1])
-                path = m.pop('path')
-                f_out.write(dict2meta(m, level=level))
-                with gzip.open(path, "rt") as f:
-                    for line in f:
-                        f_out.write(line)
+        for start, path in items:
+            if start is not None:
+                f_out.write(start)
+            with open_vrt(path, "rt", threads=threads) as f:
+                for line in f:
+                    f_out.write(line)
+            if start is not None:
                 f_out.write(f"</{level}>\n")
-
-        else:
-            pb = Progress(length=len(paths_in), rate=1)
-            for path in sorted(paths_in):
-                with gzip.open(path, "rt") as f:
-                    for line in f:
-                        f_out.write(line)
-                pb.up()
+            pb.up()
 
         f_out.write("</corpus>\n")
 
@@ -83,15 +156,11 @@ def main(args):
 
     if args.cohorts_info:
         # read cohorts info
-        meta = read_cohorts_info(glob(args.cohorts_info))
+        meta = read_cohorts_info(glob(args.cohorts_info), jobs=args.jobs)
         meta = meta.sort_values(by=args.order)
         meta = meta.rename({'cohort_clear': 'id'}, axis=1)
-        # add paths
-        meta['path'] = None
-        for p in paths_in:
-            cohort_idx = p.split("/")[-1].split(".vrt.gz")[0]
-            meta.loc[cohort_idx, 'path'] = p
+        meta = add_paths(meta, paths_in)
     else:
         meta = None
 
-    write_cohorts(paths_in, path_out, corpus_name, meta)
+    write_cohorts(paths_in, path_out, corpus_name, meta, bgzf=args.bgzf, threads=args.threads, recompress=args.recompress)
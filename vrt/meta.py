@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
-import gzip
+from functools import partial
 from glob import glob
+from operator import sub
 
 from xml.etree.ElementTree import ParseError
-from pandas import concat, DataFrame
-
-from vrt.utils import Progress, is_gz_file, save_path_out
+from numpy import array, asarray, concatenate, full
+from pandas import Categorical, DataFrame, Index, concat, to_numeric
+from pandas.api.types import union_categoricals
+
+from vrt.parquet import PartWriter, init_dataset
+from vrt.shard import find_shards, iter_shard
+from vrt.stream import P_ATT, S_CLOSE, S_OPEN, iter_path
+from vrt.utils import Progress, multi_proc, save_path_out
 from vrt.vrt import meta2dict, remove_whitespace
 
 
@@ -26,53 +31,183 @@ def topic_checker(token_list, topic_list):
     return out
 
 
+def _compact(values):
+    """convert list of strings (or None) to a compact array:
+    dictionary-encoded (categorical) unless most values are unique
+
+    """
+    if len(set(values)) <= len(values) // 2:
+        return Categorical(values)
+    return array(values, dtype=object)
+
+
+def _null(length):
+    """categorical array of {length} nulls"""
+    return Categorical.from_codes(full(length, -1, dtype="int8"), categories=[])
+
+
+def _concat(chunks):
+    """concatenate chunks of one column"""
+    if len(chunks) == 1:
+        return chunks[0]
+    if all(isinstance(chunk, Categorical) for chunk in chunks):
+        return union_categoricals(chunks, sort_categories=True)
+    if all(asarray(chunk).dtype.kind in "iuf" for chunk in chunks):
+        return concatenate([asarray(chunk) for chunk in chunks])
+    return concatenate([asarray(chunk, dtype=object) for chunk in chunks])
+
+
+def _infer_type(column):
+    """convert column to numeric if all (non-null) values are numbers"""
+    try:
+        return to_numeric(column.astype(object))
+    except (ValueError, TypeError):
+        return column
+
+
 class Meta:
     """wrapper for creating dataframes from s-atts
 
+    rows are buffered and flushed every {chunk_size} rows into compact
+    columnar chunks: strings are dictionary-encoded (categorical) unless
+    most of them are unique, missing values are real nulls
+
     """
-    def __init__(self):
-        """"""
-        self.variables = dict()
-        self.ids = list()
-        self.df = None
+    def __init__(self, chunk_size=100000, infer_types=False, sink=None):
+        """
+
+        :param int chunk_size: number of rows to buffer before flushing
+        :param bool infer_types: convert numeric columns to numbers in get_df()
+        :param sink: write flushed chunks here (e.g. vrt.parquet.PartWriter) instead of keeping them
+        """
+        self.chunk_size = chunk_size
+        self.infer_types = infer_types
+        self.sink = sink
+
+        self.columns = dict()   # name → list of flushed chunks
+        self.ids = list()       # flushed chunks of ids
+        self.counts = list()    # names of count columns (always come last)
+        self.nr_rows = 0        # number of flushed rows
+
+        self.buffer = dict()    # name → list of values of current chunk (None if missing)
+        self.buffer_ids = list()
+        self.buffer_counts = dict()
+        self.nr_buffered = 0
 
-    def add_meta_dict(self, meta_dict, idx_key='id', path=None):
-        """"""
+        self.df = None
 
-        # just for the lolz
-        meta_dict = dict(meta_dict)
+    def add_meta_dict(self, meta_dict, idx_key='id', path=None, counts=None):
+        """
 
-        # remove TSV-breaking whitespace
-        for k in meta_dict.keys():
-            meta_dict[k] = remove_whitespace(meta_dict[k])
+        :param dict counts: name → number, stored in integer columns
+        """
 
         # id
         if idx_key:
-            idx = meta_dict.pop(idx_key)
-            self.ids.append(idx)
+            meta_dict = dict(meta_dict)
+            self.buffer_ids.append(remove_whitespace(meta_dict.pop(idx_key)))
 
         # save path-specific info
         if path is not None:
+            meta_dict = dict(meta_dict)
             meta_dict['path'] = path
 
-        # add all meta data, append previously unencountered columns on the fly
-        for k in meta_dict.keys():
-            if k not in self.variables.keys():
-                nr_missing = len(self.ids) - 1
-                self.variables[k] = ["None" for i in range(nr_missing)]
-            self.variables[k].append(meta_dict[k])
+        # add all meta data (without TSV-breaking whitespace), append previously unencountered columns on the fly
+        for k, v in meta_dict.items():
+            column = self.buffer.get(k)
+            if column is None:
+                column = self.buffer[k] = [None] * self.nr_buffered
+            column.append(remove_whitespace(v))
+        self.nr_buffered += 1
 
         # append a None for all unencountered meta data
-        for k in self.variables.keys():
-            if k not in meta_dict.keys():
-                self.variables[k].append("None")
+        if len(self.buffer) > len(meta_dict):
+            for column in self.buffer.values():
+                if len(column) < self.nr_buffered:
+                    column.append(None)
+
+        if counts is not None:
+            for k, v in counts.items():
+                column = self.buffer_counts.get(k)
+                if column is None:
+                    column = self.buffer_counts[k] = list()
+                    if k not in self.counts:
+                        self.counts.append(k)
+                column.append(v)
+
+        if self.nr_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """move buffered rows to compact columns"""
+
+        if self.nr_buffered == 0:
+            return
+
+        chunk = {k: _compact(values) for k, values in self.buffer.items()}
+        chunk.update({k: array(values, dtype="int64") for k, values in self.buffer_counts.items()})
+        ids = array(self.buffer_ids, dtype=object) if len(self.buffer_ids) > 0 else None
+
+        if self.sink is not None:
+            self.sink.write(ids, self._order(chunk))
+
+        else:
+            for k in self.columns.keys():
+                if k not in chunk.keys():
+                    self.columns[k].append(_null(self.nr_buffered))
+
+            for k, values in chunk.items():
+                if k not in self.columns.keys():
+                    self.columns[k] = [_null(self.nr_rows)] if self.nr_rows > 0 else []
+                self.columns[k].append(values)
+
+            if ids is not None:
+                self.ids.append(ids)
+
+        self.nr_rows += self.nr_buffered
+        self.buffer = dict()
+        self.buffer_ids = list()
+        self.buffer_counts = dict()
+        self.nr_buffered = 0
+        self.df = None
+
+    def _order(self, columns):
+        """move count columns to the end"""
+        ordered = {k: v for k, v in columns.items() if k not in self.counts}
+        ordered.update({k: columns[k] for k in self.counts if k in columns})
+        return ordered
+
+    def __len__(self):
+        return self.nr_rows + self.nr_buffered
+
+    def extend(self, other):
+        """append all rows of other Meta, append previously unencountered columns"""
+
+        self.flush()
+        other.flush()
+
+        for k in self.columns.keys():
+            if k not in other.columns.keys():
+                self.columns[k].append(_null(other.nr_rows))
+
+        for k, chunks in other.columns.items():
+            if k not in self.columns.keys():
+                self.columns[k] = [_null(self.nr_rows)] if self.nr_rows > 0 else []
+            self.columns[k].extend(chunks)
+
+        self.ids.extend(other.ids)
+        self.counts.extend(k for k in other.counts if k not in self.counts)
+        self.nr_rows += other.nr_rows
+        self.df = None
 
     def get_df(self):
         """"""
-        df = DataFrame(index=self.ids, dtype=str)
+        self.flush()
+        index = Index(_concat(self.ids), dtype=object) if len(self.ids) > 0 else None
+        df = DataFrame({k: _concat(chunks) for k, chunks in self._order(self.columns).items()}, index=index)
         df.index.name = "id"
-        for k in self.variables.keys():
-            df[k] = self.variables[k]
+        if self.infer_types:
+            df = df.apply(_infer_type)
         self.df = df
         return df
 
@@ -80,82 +215,134 @@ class Meta:
         """"""
         if self.df is None:
             self.get_df()
-        self.df.to_csv(p_out, sep=sep, compression=compression)
+        self.df.to_csv(p_out, sep=sep, compression=compression, na_rep="None")
 
 
-def process_path(path_in, path_out, force, level, tokens, extra, idx_key, s_atts=[]):
-    """"""
+def collect(events, level, tokens, extra, idx_key, s_atts=[], region_nr=0, meta=None):
+    """collect meta data of {level} regions from (kind, name, line)-events
+
+    single pass that dispatches on the tag name once per line: tokens
+    and closed regions of every counted s-att are counted globally, the
+    counts of a {level} region are the differences between its closing
+    and opening tag; the cost per line does not depend on the number of
+    counted s-atts
+
+    :param int region_nr: number of {level} regions before the first event (for fallback IDs)
+    :param Meta meta: add rows to this Meta (e.g. one writing to a sink)
+    """
 
     # init data containers
-    meta = Meta()
+    if meta is None:
+        meta = Meta()
+    extra = set(extra)
     extra_info = dict()
-    if len(s_atts) > 0:
-        nr_s = {s: 0 for s in s_atts}
-        nr_s_regions = defaultdict(list)
-    if tokens:
-        nr = 0
-        nr_tokens = list()
-
-    # iterate over file
-    print("collecting meta data")
-    f_in = gzip.open(path_in, "rt") if is_gz_file(path_in) else open(path_in, "rt")
+
+    # one counter per s-att (regions of {level} itself are not counted inside themselves)
+    names = list(dict.fromkeys(s_atts))
+    count_keys = [f'nr_{s}' for s in names]
+    slots = {s: i for i, s in enumerate(names) if s != level}
+    counters = [0] * len(names)
+    counters_start = counters
+
+    # iterate over events
     pb = Progress()
-    cpos = 0
-    for line in f_in:
-        # count tokens
-        if tokens:
-            if line.startswith(f"<{level}>") or line.startswith(f"<{level} "):
-                nr = 0
-            elif line.startswith(f"</{level}>"):
-                nr_tokens.append(nr)
-            elif not line.startswith("<"):
-                nr += 1
-                cpos += 1
-
-        # count s-att
-        for s in s_atts:
-            if line.startswith(f"<{level}>") or line.startswith(f"<{level} "):
-                nr_s[s] = 0
-            elif line.startswith(f"</{level}>"):
-                nr_s_regions[s].append(nr_s[s])
-            elif line.startswith(f"</{s}>"):
-                nr_s[s] += 1
-
-        # meta data
-        if line.startswith("<"):
-            for e in extra:
-                if line.startswith(f"<{e}>") or line.startswith(f"<{e} "):
-                    ex = meta2dict(line, level=e)
-                    for key in ex:
-                        extra_info["_".join([e, key])] = ex[key]
-
-            if line.startswith(f"<{level}>") or line.startswith(f"<{level} "):
+    cpos = cpos_start = 0
+    m = dict()
+    for kind, name, line in events:
+
+        if kind == P_ATT:
+            cpos += 1
+
+        elif kind == S_CLOSE:
+            slot = slots.get(name)
+            if slot is not None:
+                counters[slot] += 1
+
+            if name == level:
+                if idx_key not in m.keys():
+                    m[idx_key] = 'c_' + str(region_nr + pb.c)
+                counts = {'nr_tokens': cpos - cpos_start} if tokens else dict()
+                counts.update(zip(count_keys, map(sub, counters, counters_start)))
+                meta.add_meta_dict(m, idx_key=idx_key, counts=counts)
+                pb.up()
+
+        elif kind == S_OPEN:
+            if name in extra:
+                ex = meta2dict(line.decode(), level=name)
+                for key in ex:
+                    extra_info["_".join([name, key])] = ex[key]
+
+            if name == level:
+                cpos_start = cpos
+                counters_start = counters.copy()
                 try:
-                    m = meta2dict(line, level)
+                    m = meta2dict(line.decode(), level)
                 except ParseError:
-                    print(f'invalid line: "{line}"')
+                    print(f'invalid line: "{line.decode()}"')
                 else:
                     for key in extra_info:
                         m[key] = extra_info[key]
 
-            if line.startswith(f"</{level}>"):
-                if idx_key not in m.keys():
-                    m[idx_key] = 'c_' + str(pb.c)
-                meta.add_meta_dict(m, idx_key=idx_key)
-                pb.up()
-
-    f_in.close()
     pb.fine()
+    meta.flush()
+
+    return meta
 
-    # add token information
-    if tokens:
-        meta.variables['nr_tokens'] = nr_tokens
 
-    for s in s_atts:
-        meta.variables[f'nr_{s}'] = nr_s_regions[s]
+def _new_meta(path_dataset, name):
+    """Meta writing its chunks to dataset (if given)"""
+    return Meta() if path_dataset is None else Meta(sink=PartWriter(path_dataset, name))
+
+
+def _collect_shard(item, path_in, level, tokens, extra, idx_key, s_atts, path_dataset=None, name="part"):
+    """"""
+    nr, shard = item
+    meta = _new_meta(path_dataset, f"{name}-{nr:05d}")
+    return collect(iter_shard(path_in, shard), level, tokens, extra, idx_key, s_atts, region_nr=shard[2], meta=meta)
+
+
+def collect_sharded(path_in, nr_shards, level, tokens, extra, idx_key, s_atts=[], path_dataset=None, name="part"):
+    """collect meta data of shards of path_in on {nr_shards} processes
+
+    :param str path_dataset: write Parquet parts of each shard to this dataset instead of returning rows
+    """
+
+    if len(extra) > 0:
+        print("warning: extra levels span shard boundaries, collecting meta data in one process")
+        nr_shards = 1
+
+    shards = find_shards(path_in, level, nr_shards)
+    if len(shards) == 1:
+        return collect(iter_path(path_in), level, tokens, extra, idx_key, s_atts, meta=_new_meta(path_dataset, name))
+
+    processor = partial(_collect_shard, path_in=path_in, level=level, tokens=tokens, extra=extra,
+                        idx_key=idx_key, s_atts=s_atts, path_dataset=path_dataset, name=name)
+    meta = Meta()
+    for m in multi_proc(processor, list(enumerate(shards)), nr_cpus=len(shards)):
+        meta.extend(m)
+
+    return meta
+
+
+def process_path(path_in, path_out, force, level, tokens, extra, idx_key, s_atts=[], shards=1, parquet=False, name="part"):
+    """
+
+    :param bool parquet: path_out is a Parquet dataset (see vrt.parquet), rows are written while scanning
+    :param str name: prefix of Parquet parts
+    """
+
+    path_dataset = path_out if parquet else None
+
+    print("collecting meta data")
+    if shards > 1:
+        meta = collect_sharded(path_in, shards, level, tokens, extra, idx_key, s_atts, path_dataset, name)
+    else:
+        meta = collect(iter_path(path_in), level, tokens, extra, idx_key, s_atts, meta=_new_meta(path_dataset, name))
 
     # save
-    if path_out is not None:
+    if parquet:
+        print(f"done. output written to {path_out}")
+    elif path_out is not None:
         print("saving file")
         meta.to_csv(path_out)
         print(f"done. output written to {path_out}")
@@ -163,35 +350,65 @@ def process_path(path_in, path_out, force, level, tokens, extra, idx_key, s_atts
         return meta
 
 
+def _process_file(item, force, level, tokens, extra, idx_key, s_atts, shards, parquet):
+    """process one file, return dataframe if it is not saved"""
+
+    nr, path_in, path_out = item
+    name = f"part-{nr:05d}" if parquet else "part"
+    m = process_path(path_in, path_out, force, level, tokens, extra, idx_key, s_atts, shards, parquet, name)
+
+    return None if m is None else m.get_df()
+
+
 def main(args):
     """"""
 
-    paths_in = glob(args.glob_in)
+    paths_in = sorted(glob(args.glob_in))
+
+    parquet = args.parquet or (args.path_out is not None and args.path_out.endswith(".parquet"))
+    suffix = ".parquet" if parquet else ".tsv.gz"
 
+    path_out = None
     if args.path_out is not None:
-        f_name, path_out = save_path_out(paths_in[0], args.path_out, suffix=".tsv.gz", force=args.force)
+        f_name, path_out = save_path_out(paths_in[0], args.path_out, suffix=suffix, force=args.force)
+        if parquet:
+            init_dataset(path_out, force=True)
 
-    ms = list()
+    # one output file per input file unless path_out is given
+    paths_out = list()
     for p in paths_in:
-
         if path_out:
-            p_out = None
+            # parts of all files are written to the same dataset
+            paths_out.append(path_out if parquet else None)
         else:
-            f_name, p_out = save_path_out(p, None, suffix=".tsv.gz", force=args.force)
-
-        m = process_path(p,
-                         p_out,
-                         args.force,
-                         args.level,
-                         args.tokens,
-                         args.extra,
-                         args.index,
-                         args.s_atts)
+            f_name, p_out = save_path_out(p, None, suffix=suffix, force=args.force)
+            if parquet:
+                init_dataset(p_out, force=True)
+            paths_out.append(p_out)
+
+    shards = args.shards
+    if args.jobs > 1 and shards > 1:
+        print("warning: processing files in parallel, ignoring --shards")
+        shards = 1
+
+    processor = partial(_process_file,
+                        force=args.force,
+                        level=args.level,
+                        tokens=args.tokens,
+                        extra=args.extra,
+                        idx_key=args.index,
+                        s_atts=args.s_atts,
+                        shards=shards,
+                        parquet=parquet)
+
+    items = [(nr, p_in, p_out) for nr, (p_in, p_out) in enumerate(zip(paths_in, paths_out))]
+    if args.jobs > 1:
+        dfs = multi_proc(processor, items, nr_cpus=args.jobs)
+    else:
+        dfs = map(processor, items)
 
-        df = m.get_df()
-        if df is not None:
-            ms.append(df)
+    ms = [df for df in dfs if df is not None]
 
     if len(ms) > 0 and path_out:
         m = concat(ms)
-        m.to_csv(path_out, sep="\t", compression="gzip")
+        m.to_csv(path_out, sep="\t", compression="gzip", na_rep="None")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""MinHash signatures and locality-sensitive hashing (LSH)
+
+- regions are represented by the set of their k-token shingles
+- the MinHash signature of a set consists of the minima of {num_perm}
+  random hash permutations; the share of equal positions in two
+  signatures estimates the Jaccard similarity of the sets
+- LSH splits signatures into bands of rows; regions whose signatures
+  agree on all rows of at least one band share a bucket.  with
+  sorting per band, finding buckets is O(n log n) instead of
+  comparing all n² pairs; within a bucket, every region is compared
+  with the first region of each cluster found in it so far
+
+shingle hashes (crc32) and permutations (fixed seed) are
+deterministic, so signatures of different processes and runs are
+comparable.
+
+"""
+
+from zlib import crc32
+
+from numpy import arange, array, asarray, bitwise_and, concatenate, flatnonzero, full, random, uint32, uint64, unique
+
+_PRIME = uint64((1 << 61) - 1)
+_MAX_HASH = uint64((1 << 32) - 1)
+
+
+def permutations(num_perm=128, seed=1):
+    """parameters (a, b) of {num_perm} hash permutations"""
+    generator = random.RandomState(seed)
+    a = generator.randint(1, (1 << 61) - 1, size=num_perm, dtype=uint64)
+    b = generator.randint(0, (1 << 61) - 1, size=num_perm, dtype=uint64)
+    return a, b
+
+
+def shingle_hashes(tokens, k=3):
+    """crc32 hashes of all k-token shingles (one shingle if there are fewer tokens)"""
+    tokens = [t for t in tokens if t]
+    if len(tokens) == 0:
+        return []
+    if len(tokens) <= k:
+        return [crc32("\x1f".join(tokens).encode())]
+    return list({crc32("\x1f".join(tokens[i: i + k]).encode()) for i in range(len(tokens) - k + 1)})
+
+
+def signature(tokens, perms, k=3):
+    """MinHash signature (uint32 array) of the k-shingles of tokens;
+    all positions are maximal for regions without tokens
+
+    """
+    a, b = perms
+    hashes = shingle_hashes(tokens, k)
+    if len(hashes) == 0:
+        return full(len(a), _MAX_HASH, dtype=uint32)
+    hashes = asarray(hashes, dtype=uint64)
+    # (a * x + b) mod p, truncated to 32 bit (multiplication wraps around on purpose)
+    values = bitwise_and((hashes[:, None] * a[None, :] + b[None, :]) % _PRIME, _MAX_HASH)
+    return values.min(axis=0).astype(uint32)
+
+
+def jaccard(sig_a, sig_b):
+    """estimated Jaccard similarity of two signatures"""
+    return float((sig_a == sig_b).mean())
+
+
+def bands_rows(threshold, num_perm):
+    """choose number of bands and rows (bands * rows = num_perm) so that
+    the LSH threshold (1 / bands) ** (1 / rows) is closest to {threshold}
+
+    """
+    best = None
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands != 0:
+            continue
+        rows = num_perm // bands
+        distance = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or distance < best[0]:
+            best = (distance, bands, rows)
+    return best[1], best[2]
+
+
+def row_hashes(signatures, start=0, end=None):
+    """combine positions [start, end) of every signature into one 64-bit hash (FNV-1a style)"""
+    end = signatures.shape[1] if end is None else end
+    h = full(signatures.shape[0], 1469598103934665603, dtype=uint64)
+    for position in range(start, end):
+        h = (h ^ signatures[:, position].astype(uint64)) * uint64(1099511628211)
+    return h
+
+
+def candidate_buckets(signatures, bands, rows):
+    """yield arrays of signature rows that agree on all rows of a band
+    (buckets with at least two members, one band after another)
+
+    """
+    for band in range(bands):
+        h = row_hashes(signatures, band * rows, (band + 1) * rows)
+        order = h.argsort(kind="stable")
+        h = h[order]
+        starts = flatnonzero(concatenate([[True], h[1:] != h[:-1]]))
+        ends = concatenate([starts[1:], [len(h)]])
+        for pos in flatnonzero(ends - starts > 1):
+            yield order[starts[pos]: ends[pos]]
+
+
+def find(parent, i):
+    """root of i (with path halving)"""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def clusters(signatures, threshold=0.8, bands=None, rows=None):
+    """cluster signatures: union candidates of LSH whose estimated
+    Jaccard similarity is at least {threshold}
+
+    :return: array of cluster labels (one per signature)
+    """
+    # identical signatures (e.g. exact duplicates) only have to be clustered once
+    _, first, inverse = unique(row_hashes(signatures), return_index=True, return_inverse=True)
+    signatures = signatures[first]
+    n, num_perm = signatures.shape
+    if bands is None or rows is None:
+        bands, rows = bands_rows(threshold, num_perm)
+
+    parent = arange(n)
+    empty_signature = full(num_perm, _MAX_HASH, dtype=uint32)
+    for bucket in candidate_buckets(signatures, bands, rows):
+        # every member is compared with the members that did not match any earlier one
+        leaders = list()
+        for i in bucket:
+            if (signatures[i] == empty_signature).all():
+                continue        # regions without tokens are not similar to anything
+            matched = False
+            for j in leaders:
+                root_i, root_j = find(parent, i), find(parent, j)
+                if root_i == root_j:
+                    matched = True
+                elif jaccard(signatures[i], signatures[j]) >= threshold:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+                    matched = True
+            if not matched:
+                leaders.append(i)
+
+    return array([find(parent, i) for i in range(n)])[inverse.reshape(-1)]
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""region offset index: random access to regions of one level
+
+the sidecar ({f_name}-{level}.offsets next to the VRT file) contains
+
+- header: magic, level, number of regions, size and modification
+  time of the VRT file (an index of a file that has changed since is
+  rejected)
+- one record per region: (uncompressed) byte offsets of start and
+  end and the corpus positions [cpos_start, cpos_end) of its tokens
+- the ids of all regions
+
+regions can then be fetched with one seek: directly for plain VRT
+files, via the block index (.gzi) for BGZF files.  ordinary gzip
+files cannot be seeked efficiently (convert them to BGZF, e.g. with
+vrt-merge --bgzf).
+
+"""
+
+import gzip
+import os
+import struct
+from array import array
+from xml.etree.ElementTree import ParseError
+
+from vrt.bgzf import BgzfReader, is_bgzf_file
+from vrt.stream import iter_offsets, open_vrt
+from vrt.utils import Progress, is_gz_file, save_path_out
+from vrt.vrt import meta2dict
+
+MAGIC = b"VRTOFF2\n"
+_HEADER = struct.Struct("<HQQd")  # length of level name, number of regions, size and mtime of VRT file
+_RECORD = "Q"                   # start, end, cpos_start, cpos_end per region
+
+
+def path_offsets(path_in, level):
+    """default location of the offset index of {level} regions"""
+    f_name = path_in.split("/")[-1].split(".")[0].lower()
+    return os.path.join(os.path.dirname(path_in), f"{f_name}-{level}.offsets")
+
+
+def build_offsets(path_in, level='text', id_attribute='id'):
+    """scan VRT file once and collect offsets, corpus positions and ids
+    of all {level} regions
+
+    """
+
+    tag_open = f"<{level}".encode()
+    tag_close = f"</{level}>".encode()
+
+    records = array(_RECORD)
+    ids = list()
+
+    pb = Progress(rate=10)
+    cpos = 0
+    start = cpos_start = idx = None
+    with open_vrt(path_in) as f:
+        for offset, line in iter_offsets(f):
+
+            if line[:1] != b"<":
+                cpos += 1
+
+            elif line.startswith(tag_open) and line[len(tag_open): len(tag_open) + 1] in (b" ", b">", b"\t"):
+                start, cpos_start = offset, cpos
+                try:
+                    idx = meta2dict(line.decode(), level).get(id_attribute, "")
+                except ParseError:
+                    print(f'invalid line: "{line.decode()}"')
+                    idx = ""
+
+            elif line.startswith(tag_close) and start is not None:
+                records.extend([start, offset + len(line) + 1, cpos_start, cpos])
+                ids.append(idx)
+                start = None
+                pb.up()
+
+    pb.fine()
+
+    return records, ids
+
+
+def write_offsets(path, level, records, ids, path_in):
+    """write offset index of VRT file path_in"""
+    stat = os.stat(path_in)
+    level = level.encode()
+    ids = [idx.encode() for idx in ids]
+    id_offsets = array("Q", [0])
+    for idx in ids:
+        id_offsets.append(id_offsets[-1] + len(idx))
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(_HEADER.pack(len(level), len(ids), stat.st_size, stat.st_mtime))
+        f.write(level)
+        f.write(records.tobytes())
+        f.write(id_offsets.tobytes())
+        f.write(b"".join(ids))
+
+
+class RegionIndex:
+    """random access to the {level} regions of a VRT file via its offset index
+
+    raises ValueError if the index is invalid or the VRT file has changed since it was built
+    """
+
+    def __init__(self, path_in, level='text', path_index=None):
+
+        self.path_in = path_in
+        self.path_index = path_offsets(path_in, level) if path_index is None else path_index
+
+        with open(self.path_index, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'"{self.path_index}" is not a region offset index (of this version)')
+            len_level, nr, size, mtime = _HEADER.unpack(f.read(_HEADER.size))
+            stat = os.stat(path_in)
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                raise ValueError(f'"{path_in}" has changed since "{self.path_index}" was built')
+            self.level = f.read(len_level).decode()
+            self.records = array(_RECORD)
+            self.records.frombytes(f.read(4 * nr * self.records.itemsize))
+            self.id_offsets = array("Q")
+            self.id_offsets.frombytes(f.read((nr + 1) * self.id_offsets.itemsize))
+            self.id_blob = f.read()
+
+        self.id2nr = None
+        self.f = None
+
+    def __len__(self):
+        return len(self.id_offsets) - 1
+
+    def __iter__(self):
+        for nr in range(len(self)):
+            yield self.region(nr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_id(self, nr):
+        return self.id_blob[self.id_offsets[nr]: self.id_offsets[nr + 1]].decode()
+
+    def region(self, nr):
+        """offsets, corpus positions and id of region number {nr}"""
+        start, end, cpos_start, cpos_end = self.records[4 * nr: 4 * nr + 4]
+        return {
+            'nr': nr,
+            'id': self.get_id(nr),
+            'start': start,
+            'end': end,
+            'cpos_start': cpos_start,
+            'cpos_end': cpos_end
+        }
+
+    def find(self, idx):
+        """number of region with id {idx} (first one if not unique)"""
+        if self.id2nr is None:
+            self.id2nr = dict()
+            for nr in reversed(range(len(self))):
+                self.id2nr[self.get_id(nr)] = nr
+        return self.id2nr[idx]
+
+    def _open(self):
+        if self.f is None:
+            if not is_gz_file(self.path_in):
+                self.f = open(self.path_in, "rb")
+            elif is_bgzf_file(self.path_in):
+                self.f = BgzfReader(self.path_in)
+            else:
+                print("warning: file is not BGZF-compressed, seeking requires decompressing from the start")
+                self.f = gzip.open(self.path_in, "rb")
+        return self.f
+
+    def fetch(self, nr):
+        """raw lines (bytes) of region number {nr}, including its tags"""
+        start, end = self.records[4 * nr: 4 * nr + 2]
+        f = self._open()
+        f.seek(start)
+        chunks = list()
+        size = end - start
+        while size > 0:
+            chunk = f.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def fetch_id(self, idx):
+        """raw lines (bytes) of region with id {idx}"""
+        return self.fetch(self.find(idx))
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def process_path(path_in, path_out, force, level, id_attribute='id'):
+    """"""
+
+    if path_out is None:
+        path_out = path_offsets(path_in, level)
+    f_name, path_out = save_path_out(path_in, path_out, force=force)
+
+    if is_gz_file(path_in) and not is_bgzf_file(path_in):
+        print("warning: input is not BGZF-compressed, random access will be slow")
+
+    print(f"collecting offsets of <{level}> regions")
+    records, ids = build_offsets(path_in, level, id_attribute)
+    write_offsets(path_out, level, records, ids, path_in)
+
+    print(f"output written to {path_out}")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Parquet datasets of meta data
+
+a dataset is a directory of Parquet files (parts), each holding one
+chunk of rows.  parts are written while scanning, so memory stays
+bounded; every part has its own schema (attributes encountered later
+simply appear in later parts).  read_meta() unifies the schemas and
+returns all rows in the order of the (sorted) part names.
+
+requires pyarrow (pip install pyarrow).
+
+"""
+
+import os
+from glob import glob
+
+from numpy import asarray
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet output requires pyarrow, install it with: pip install pyarrow")
+    return pyarrow
+
+
+def init_dataset(path, force=False):
+    """create empty dataset directory (remove parts of existing one if forced)"""
+
+    if os.path.exists(path):
+        if not force:
+            raise FileExistsError(f'error: dataset "{path}" already exists')
+        for p in glob(os.path.join(path, "*.parquet")):
+            os.remove(p)
+    os.makedirs(path, exist_ok=True)
+
+
+class PartWriter:
+    """write chunks of rows as parts {name}-00000.parquet, {name}-00001.parquet, … to dataset directory
+
+    """
+
+    def __init__(self, path, name="part"):
+
+        _import_pyarrow()       # fail early
+        self.path = path
+        self.name = name
+        self.nr_parts = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, ids, columns):
+        """write one part
+
+        :param ids: array of ids (or None)
+        :param dict columns: name → array (numeric, or strings / categorical with nulls)
+        """
+
+        pa = _import_pyarrow()
+        arrays, names = list(), list()
+        if ids is not None:
+            arrays.append(pa.array(asarray(ids, dtype=object), type=pa.string()))
+            names.append("id")
+        for k, values in columns.items():
+            values = asarray(values)
+            if values.dtype.kind in "iuf":
+                arrays.append(pa.array(values))
+            else:
+                # nulls of categorical chunks are NaN as objects
+                arrays.append(pa.array(asarray(values, dtype=object), type=pa.string(), from_pandas=True))
+            names.append(k)
+
+        table = pa.Table.from_arrays(arrays, names=names)
+        path = os.path.join(self.path, f"{self.name}-{self.nr_parts:05d}.parquet")
+        pa.parquet.write_table(table, path)
+        self.nr_parts += 1
+
+
+def read_meta(path, categorical=True):
+    """read dataset (directory of parts or single Parquet file) into a dataframe indexed by id
+
+    :param bool categorical: dictionary-encode string columns
+    """
+
+    pa = _import_pyarrow()
+
+    paths = sorted(glob(os.path.join(path, "*.parquet"))) if os.path.isdir(path) else [path]
+    tables = [pa.parquet.read_table(p) for p in paths]
+    if len(tables) == 0:
+        raise FileNotFoundError(f'no parts found in "{path}"')
+    table = pa.concat_tables(tables, promote_options="default")
+
+    if categorical:
+        columns = [
+            c.dictionary_encode() if pa.types.is_string(c.type) and name != "id" else c
+            for name, c in zip(table.column_names, table.columns)
+        ]
+        table = pa.Table.from_arrays(columns, names=table.column_names)
+
+    df = table.to_pandas()
+    if "id" in df.columns:
+        df = df.set_index("id")
+    return df
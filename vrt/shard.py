@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""split single VRT files into shards at region boundaries
+
+a shard is a tuple (start, end, region_nr):
+
+- start, end: uncompressed byte offsets (end=None: until end of file)
+- region_nr: number of regions before the shard
+
+shard boundaries are taken from a region offset index (see
+vrt.offsets) if available, otherwise they are found by one fast pass
+over the file.  the first shard contains everything before the first
+region (declarations, <corpus>), the last one everything after the
+last region, so processing all shards in order is equivalent to
+processing the whole file.
+
+shards can only be read independently from seekable files (plain or
+BGZF); ordinary gzip files are treated as one single shard.
+
+"""
+
+import gzip
+import io
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from functools import partial
+from shutil import copyfileobj
+
+from vrt.bgzf import BgzfReader, is_bgzf_file, load_index
+from vrt.offsets import RegionIndex, path_offsets
+from vrt.stream import CHUNK_SIZE, iter_events, iter_offsets, open_vrt
+from vrt.utils import is_gz_file, multi_proc
+
+# maximum number of sampled region starts kept in memory while scanning
+MAX_SAMPLES = 1 << 16
+
+
+def is_seekable(path):
+    """can shards of path be read independently?"""
+    return not is_gz_file(path) or is_bgzf_file(path)
+
+
+def scan_region_starts(path, level, threads=1):
+    """one pass over the file: collect byte offsets of (every n-th) region start
+
+    :return: offsets of region starts, n, total number of bytes
+    """
+
+    pattern = re.compile(rb"^<" + re.escape(level.encode()) + rb"[ \t>]", re.M)
+
+    starts = array("Q")
+    every = 1
+    nr = 0
+    offset = 0                  # offset of first byte in data
+    carry = b""
+    with open_vrt(path, threads=threads) as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            data = carry + chunk
+            cut = data.rfind(b"\n") + 1 if chunk else len(data)
+            for hit in pattern.finditer(data, 0, cut):
+                if nr % every == 0:
+                    starts.append(offset + hit.start())
+                    if len(starts) > MAX_SAMPLES:
+                        # keep memory bounded: only sample every second one
+                        starts = starts[::2]
+                        every *= 2
+                nr += 1
+            carry = data[cut:]
+            offset += cut
+            if not chunk:
+                break
+
+    return starts, every, offset
+
+
+def find_shards(path, level, nr_shards, threads=1):
+    """split file into (at most) {nr_shards} shards of similar size at {level} region boundaries
+
+    """
+
+    if nr_shards <= 1:
+        return [(0, None, 0)]
+
+    if not is_seekable(path):
+        print("warning: file is not seekable (plain gzip), processing it as one shard (convert to BGZF to enable sharding)", file=sys.stderr)
+        return [(0, None, 0)]
+
+    if is_bgzf_file(path):
+        # every worker seeks via the block index
+        load_index(path, write=True)
+
+    index = None
+    if os.path.exists(path_offsets(path, level)):
+        try:
+            index = RegionIndex(path, level)
+        except ValueError as e:
+            print(f"warning: not using offset index: {e}", file=sys.stderr)
+
+    if index is not None:
+        starts = index.records[0::4]
+        every = 1
+        size = index.records[-3] if len(index) > 0 else 0
+    else:
+        starts, every, size = scan_region_starts(path, level, threads)
+
+    shards = list()
+    prev_start, prev_nr = 0, 0
+    for i in range(1, nr_shards):
+        j = bisect_left(starts, i * size // nr_shards)
+        if j >= len(starts) or j == 0 or starts[j] <= prev_start:
+            continue
+        shards.append((prev_start, starts[j], prev_nr))
+        prev_start, prev_nr = starts[j], j * every
+    shards.append((prev_start, None, prev_nr))
+
+    return shards
+
+
+class ShardReader(io.RawIOBase):
+    """binary file object reading the byte range [start, end) of a (BGZF) file
+
+    """
+
+    def __init__(self, path, start, end):
+
+        self.f = BgzfReader(path) if is_gz_file(path) else open(path, "rb")
+        self.f.seek(start)
+        self.remaining = end - start if end is not None else None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = len(b) if self.remaining is None else min(len(b), self.remaining)
+        if size == 0:
+            return 0
+        data = self.f.read(size)
+        b[:len(data)] = data
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def open_shard(path, shard):
+    """open shard of (BGZF) file for reading (binary)"""
+    start, end, region_nr = shard
+    if start == 0 and end is None:
+        return open_vrt(path)
+    return ShardReader(path, start, end)
+
+
+def iter_shard(path, shard):
+    """yield (kind, name, line) for every line of shard"""
+    with open_shard(path, shard) as f:
+        yield from iter_events(f)
+
+
+def enclosing_tags(path, offsets):
+    """one pass over the file: opening lines of the s-attributes that are
+    open at each of the (ascending) byte {offsets} (e.g. <corpus>, <cohort>)
+
+    :return: list of [(name, line), ...] per offset, outermost first
+    """
+
+    stacks = list()
+    if not offsets:
+        return stacks
+
+    stack = list()
+    with open_vrt(path) as f:
+        for offset, line in iter_offsets(f):
+            while offset >= offsets[len(stacks)]:
+                stacks.append(list(stack))
+                if len(stacks) == len(offsets):
+                    return stacks
+            if line[:1] != b"<" or line[1:2] in (b"?", b"!"):
+                continue
+            if line[1:2] == b"/":
+                name = line[2:].split(b">", 1)[0].strip().decode()
+                if stack and stack[-1][0] == name:
+                    stack.pop()
+            else:
+                name = line[1:].split(b" ", 1)[0].split(b">", 1)[0].strip().decode()
+                stack.append((name, line))
+
+    # offsets at the end of the file
+    while len(stacks) < len(offsets):
+        stacks.append(list(stack))
+    return stacks
+
+
+def _write_part(item, path):
+    """copy shard verbatim, wrapped in the tags that are open at its start and end"""
+    shard, path_part, opening, closing = item
+    with open_shard(path, shard) as f, gzip.open(path_part, "wb", compresslevel=1) as f_out:
+        f_out.write(b"".join(line + b"\n" for name, line in opening))
+        copyfileobj(f, f_out, CHUNK_SIZE)
+        f_out.write(b"".join(b"</" + name.encode() + b">\n" for name, line in reversed(closing)))
+    return path_part
+
+
+def write_parts(path, dir_out, level, nr_parts, threads=1, jobs=1):
+    """split file at {level} region boundaries into (at most) {nr_parts}
+    well-formed gzipped VRT files in dir_out (on {jobs} processes)
+
+    tags enclosing the {level} regions (e.g. <corpus>, <cohort>) are closed
+    at the end of each part and re-opened at the start of the next one
+
+    :return: paths of the parts
+    """
+
+    shards = find_shards(path, level, nr_parts, threads)
+    # the first part opens and the last one closes its tags itself
+    boundaries = enclosing_tags(path, [start for start, end, region_nr in shards[1:]])
+    openings = [[]] + boundaries
+    closings = boundaries + [[]]
+    os.makedirs(dir_out, exist_ok=True)
+
+    width = len(str(len(shards)))
+    items = [(shard, os.path.join(dir_out, f"part-{nr + 1:0{width}d}.vrt.gz"), openings[nr], closings[nr])
+             for nr, shard in enumerate(shards)]
+    processor = partial(_write_part, path=path)
+
+    return list(multi_proc(processor, items, nr_cpus=jobs))
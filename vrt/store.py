@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""persistent fingerprint store for incremental deduplication
+
+an SQLite database with
+
+- clusters: one row per region hash with the number of regions and
+  tokens seen so far and the (internal) id of the first region
+- files: paths (with size and modification time) that have already
+  been fingerprinted
+- contributions: number of regions and tokens of every region hash per
+  file, so that the fingerprints of a file that has changed can be
+  removed before it is added again
+
+new files are checked against the store and then added to it, so
+regular runs only have to fingerprint new data.
+
+"""
+
+import os
+import sqlite3
+
+from pandas import DataFrame
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    region_hash TEXT PRIMARY KEY,
+    nr_regions INTEGER NOT NULL,
+    nr_tokens INTEGER NOT NULL,
+    cluster_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    nr_regions INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS contributions (
+    path TEXT NOT NULL,
+    region_hash TEXT NOT NULL,
+    nr_regions INTEGER NOT NULL,
+    nr_tokens INTEGER NOT NULL,
+    PRIMARY KEY (path, region_hash)
+);
+"""
+
+
+class FingerprintStore:
+    """SQLite store of region hashes
+
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.con.execute("SELECT COUNT(*) FROM clusters").fetchone()[0]
+
+    def close(self):
+        self.con.close()
+
+    def status(self, path):
+        """"new", "known" (unchanged since it was stored) or "changed" """
+        row = self.con.execute("SELECT size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return "new"
+        stat = os.stat(path)
+        return "known" if (stat.st_size, stat.st_mtime) == tuple(row) else "changed"
+
+    def lookup(self, hashes):
+        """clusters of hashes that have been seen before
+
+        :return: dataframe indexed by region_hash with nr_regions, nr_tokens, cluster_id
+        """
+        self.con.execute("CREATE TEMP TABLE IF NOT EXISTS query (region_hash TEXT PRIMARY KEY)")
+        self.con.execute("DELETE FROM query")
+        self.con.executemany("INSERT OR IGNORE INTO query VALUES (?)", ((h,) for h in hashes))
+        rows = self.con.execute(
+            "SELECT c.region_hash, c.nr_regions, c.nr_tokens, c.cluster_id "
+            "FROM clusters c JOIN query q ON c.region_hash = q.region_hash"
+        ).fetchall()
+        self.con.execute("DELETE FROM query")
+        return DataFrame(
+            rows, columns=['region_hash', 'nr_regions', 'nr_tokens', 'cluster_id']
+        ).set_index('region_hash')
+
+    def add(self, records, paths, order=['path', 'region_nr']):
+        """add fingerprint records (see vrt.deduplicate.fingerprint) and register the fingerprinted paths"""
+
+        if len(records) == 0:
+            self.add_files(paths, dict())
+            return
+
+        regions = DataFrame.from_records(records).sort_values(by=order)
+        regions['internal_id'] = regions[order[0]].astype(str) + '_' + regions[order[1]].astype(str)
+        clusters = regions.groupby('region_hash').agg(
+            nr_regions=('region_length', 'count'),
+            nr_tokens=('region_length', 'sum'),
+            cluster_id=('internal_id', 'first')
+        )
+        contributions = regions.groupby(['path', 'region_hash']).agg(
+            nr_regions=('region_length', 'count'),
+            nr_tokens=('region_length', 'sum')
+        )
+        with self.con:
+            self.con.executemany(
+                "INSERT INTO clusters VALUES (?, ?, ?, ?) ON CONFLICT(region_hash) DO UPDATE SET "
+                "nr_regions = nr_regions + excluded.nr_regions, nr_tokens = nr_tokens + excluded.nr_tokens",
+                ((h, int(n), int(t), c) for h, n, t, c in clusters.itertuples())
+            )
+            self.con.executemany(
+                "INSERT OR REPLACE INTO contributions VALUES (?, ?, ?, ?)",
+                ((p, h, int(n), int(t)) for (p, h), n, t in contributions.itertuples())
+            )
+        self.add_files(paths, regions.groupby('path').size())
+
+    def remove(self, path):
+        """remove the fingerprints of path (e.g. because it has changed)
+
+        clusters keep their cluster_id, even if it refers to a region of path
+        """
+        with self.con:
+            self.con.execute(
+                "UPDATE clusters SET "
+                "nr_regions = nr_regions - (SELECT c.nr_regions FROM contributions c WHERE c.path = ? AND c.region_hash = clusters.region_hash), "
+                "nr_tokens = nr_tokens - (SELECT c.nr_tokens FROM contributions c WHERE c.path = ? AND c.region_hash = clusters.region_hash) "
+                "WHERE region_hash IN (SELECT region_hash FROM contributions WHERE path = ?)",
+                (path, path, path)
+            )
+            self.con.execute("DELETE FROM clusters WHERE nr_regions <= 0")
+            self.con.execute("DELETE FROM contributions WHERE path = ?", (path,))
+            self.con.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def add_files(self, paths, nr_regions):
+        """register paths as fingerprinted"""
+        with self.con:
+            for path in paths:
+                stat = os.stat(path)
+                self.con.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime, int(nr_regions.get(path, 0)))
+                )
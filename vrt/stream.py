@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""streaming tokenizer for VRT files
+
+reads (gzipped) VRT files as binary buffers in large chunks and
+classifies every line by its first bytes into compact event records
+
+    (kind, name, line)
+
+- kind: one of P_ATT, S_OPEN, S_CLOSE, DECLARATION
+- name: name of the s-attribute (None for p-attribute lines and declarations)
+- line: the raw line as bytes, without trailing line break
+
+"""
+
+import gzip
+
+from vrt.bgzf import is_bgzf_file, open_bgzf
+from vrt.utils import is_gz_file
+
+# event kinds
+P_ATT = 0
+S_OPEN = 1
+S_CLOSE = 2
+DECLARATION = 3
+
+# 16 MiB
+CHUNK_SIZE = 1 << 24
+
+_LT = 60                        # b"<"
+_SLASH = 47                     # b"/"
+_DECLARATION = (63, 33)         # b"?", b"!"
+
+
+def open_vrt(path, mode="rb", threads=1, bgzf=False):
+    """open (gzipped) VRT file, auto-detecting compression when reading
+
+    - BGZF files are decompressed on {threads} threads
+    - with bgzf=True, output is written as BGZF using {threads} threads
+
+    """
+
+    if "r" in mode:
+        if not is_gz_file(path):
+            return open(path, mode)
+        if threads > 1 and is_bgzf_file(path):
+            return open_bgzf(path, mode, threads=threads)
+
+    else:
+        if bgzf:
+            return open_bgzf(path, mode, threads=threads)
+        if not path.endswith(".gz"):
+            return open(path, mode)
+
+    return gzip.open(path, mode)
+
+
+def iter_lines(f, chunk_size=CHUNK_SIZE):
+    """yield lines (bytes, without line break) of a binary file
+    object, reading it in chunks of {chunk_size} bytes
+
+    """
+
+    rest = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line[:-1] if line[-1:] == b"\r" else line
+
+    if rest:
+        yield rest[:-1] if rest[-1:] == b"\r" else rest
+
+
+def iter_offsets(f, chunk_size=CHUNK_SIZE):
+    """yield (offset, line) for every line of a binary file object,
+    where offset is the (uncompressed) byte offset of the line start
+
+    """
+
+    offset = 0
+    rest = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield offset, line[:-1] if line[-1:] == b"\r" else line
+            offset += len(line) + 1
+
+    if rest:
+        yield offset, rest[:-1] if rest[-1:] == b"\r" else rest
+
+
+def iter_events(f, chunk_size=CHUNK_SIZE):
+    """yield (kind, name, line) for every line of a binary file object
+
+    """
+
+    names = dict()              # cache: raw tag → decoded name
+
+    for line in iter_lines(f, chunk_size):
+
+        if not line or line[0] != _LT:
+            yield P_ATT, None, line
+            continue
+
+        second = line[1] if len(line) > 1 else None
+        if second == _SLASH:
+            raw = line[2:].split(b">", 1)[0]
+            kind = S_CLOSE
+        elif second in _DECLARATION:
+            yield DECLARATION, None, line
+            continue
+        else:
+            raw = line[1:].split(b" ", 1)[0].split(b">", 1)[0]
+            kind = S_OPEN
+
+        name = names.get(raw)
+        if name is None:
+            name = names[raw] = raw.strip().decode()
+
+        yield kind, name, line
+
+
+def iter_path(path, chunk_size=CHUNK_SIZE, threads=1):
+    """yield (kind, name, line) for every line of (gzipped) VRT file at path
+
+    """
+
+    with open_vrt(path, threads=threads) as f:
+        yield from iter_events(f, chunk_size)
@@ -3,9 +3,11 @@
 
 import errno
 import gzip
+import heapq
 import os
 import re
 import sys
+from collections import OrderedDict
 from datetime import datetime
 from functools import wraps
 from multiprocessing import Pool
@@ -35,6 +37,61 @@ def save_id(id, ids):
     return id
 
 
+_SUFFIX = re.compile(r"(.*)__(\d+)$")
+
+
+class IdAllocator:
+    """resolves ID collisions like save_id (by appending or increasing a
+    "__N" suffix), but remembers which suffixes are taken for each base ID,
+    so that many colliding IDs are resolved in linear time
+
+    allocated IDs are added to {ids} (which may also be updated elsewhere)
+
+    """
+
+    def __init__(self, ids=None):
+        self.ids = set() if ids is None else ids
+        # base ID -> (low, high): all base__N with low <= N < high are in ids
+        self.taken = dict()
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def allocate(self, id):
+        """return (and reserve) {id} or the next free ID according to update_id"""
+
+        id = str(id)
+        if id not in self.ids:
+            self.ids.add(id)
+            return id
+
+        hit = _SUFFIX.match(id)
+        base, start = (hit.group(1), int(hit.group(2)) + 1) if hit else (id, 1)
+        low, high = self.taken.get(base, (start, start))
+
+        nr = start
+        while True:
+            if low <= nr < high:
+                nr = high
+            id_new = base + "__" + str(nr)
+            if id_new not in self.ids:
+                break
+            nr += 1
+
+        # base__start, ..., base__nr are taken now
+        if start <= high and low <= nr + 1:
+            self.taken[base] = (min(low, start), max(high, nr + 1))
+        else:
+            self.taken[base] = (start, nr + 1)
+
+        print(f"\nduplicate id: {id} → {id_new}", file=sys.stderr)
+        self.ids.add(id_new)
+        return id_new
+
+
 def save_path_out(path_in, path_out, suffix='.sh', force=False, dir_out=None):
 
     dir_in = os.path.dirname(path_in)
@@ -67,8 +124,8 @@ def is_gz_file(filepath):
 def multi_proc(processor, items, nr_cpus=2):
     """
     wrapper for multicore processing with progress bar
+    yields the results in the order of the items
     """
-    pool = Pool(nr_cpus)
 
     # if the number of items is explicit:
     try:
@@ -77,11 +134,68 @@ def multi_proc(processor, items, nr_cpus=2):
         total = None
 
     # loop through the items
-    for _ in tqdm(
-            pool.imap_unordered(processor, items),
-            total=total
-    ):
-        pass
+    with Pool(nr_cpus) as pool:
+        for result in tqdm(
+                pool.imap(processor, items),
+                total=total
+        ):
+            yield result
+
+
+# maximum number of sorted files merged at once
+MAX_FAN_IN = 256
+
+
+def max_fan_in():
+    """number of files that can be merged at once: MAX_FAN_IN, but at most
+    half of the limit of open files
+
+    """
+    try:
+        import resource
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ImportError, ValueError, OSError):
+        return MAX_FAN_IN
+    if limit == resource.RLIM_INFINITY:
+        return MAX_FAN_IN
+    return max(2, min(MAX_FAN_IN, limit // 2))
+
+
+def merge_files(paths, read, write, fan_in=None, prefix="merge", suffix=".bin"):
+    """yield items of sorted files in sorted order
+
+    - read(path): yields the (sorted) items of a file
+    - write(items, path): writes items to a file
+
+    at most {fan_in} [max_fan_in()] files are merged at once (open files are limited):
+    with more files, groups of files are first merged into intermediate
+    files next to them (removed once they have been merged)
+    """
+    fan_in = max_fan_in() if fan_in is None else fan_in
+    paths = list(paths)
+    intermediate = set()
+    nr_pass = 0
+    while len(paths) > fan_in:
+        merged = list()
+        for i in range(0, len(paths), fan_in):
+            group = paths[i: i + fan_in]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            path = os.path.join(os.path.dirname(group[0]), f"{prefix}-{nr_pass:03d}-{i // fan_in:05d}{suffix}")
+            write(heapq.merge(*[read(p) for p in group]), path)
+            for p in group:
+                if p in intermediate:
+                    os.remove(p)
+            merged.append(path)
+            intermediate.add(path)
+        paths = merged
+        nr_pass += 1
+
+    yield from heapq.merge(*[read(p) for p in paths])
+    for p in paths:
+        if p in intermediate:
+            os.remove(p)
 
 
 def time_it(func):
@@ -241,31 +355,58 @@ class MultiFileWriter:
     advance.  takes care of appropriately opening and closing all file
     connections, respecting the upper limit of connections.
 
-    do not forget to close files with mfw.close()
-    TODO: implement as context manager
+    - writes are buffered per path and written in blocks of {buffer_size}
+      characters (bytes in binary mode); if all buffers together exceed
+      {max_buffered}, the largest ones are written
+    - if the limit of connections is reached, the least recently used
+      connection is closed (and reopened in append mode when needed)
+    - nr_open, nr_reopen, nr_evict, nr_flush count these events
+
+    use as context manager or close files with mfw.close()
 
     """
 
-    def __init__(self, compression='gzip', init_mode='wt', create_dir=True, limit=512):
+    def __init__(self, compression='gzip', init_mode='wt', create_dir=True, limit=512,
+                 buffer_size=1 << 20, max_buffered=1 << 28):
         """
 
         :param int limit: upper limit of simultaneous connections (on Ubuntu: check with "ulimit -n" = 1024)
+        :param int buffer_size: size of the blocks written per path
+        :param int max_buffered: upper limit of the size of all buffers together
         """
         self.limit = limit
         self.init_mode = init_mode
+        self.append_mode = 'ab' if 'b' in init_mode else 'at'
         self.create_dir = create_dir
         self.compression = compression
-        self.paths = dict()     # [path]: dict(open?, count, connection)
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+
+        self.paths = dict()                 # [path]: number of writes
+        self.connections = OrderedDict()    # [path]: connection, least recently used first
+        self.opened = set()                 # paths opened at least once
+        self.buffers = dict()               # [path]: list of pending strings
+        self.buffer_lengths = dict()        # [path]: size of pending strings
+        self.nr_buffered = 0
+
         self.nr_open = 0
+        self.nr_reopen = 0
+        self.nr_evict = 0
+        self.nr_flush = 0
 
-    def _open(self, path, mode, warning=True):
+    def __enter__(self):
+        return self
 
-        # close if no more space
-        # TODO: add heuristics for closing rarely used connections instead of all
-        if self.nr_open >= self.limit:
-            if warning:
-                print('\n' + 'too many open connections, closing all of them')
-            self.close()
+    def __exit__(self, *args):
+        self.close()
+
+    def _open(self, path, mode):
+
+        # close least recently used connection if no more space
+        if len(self.connections) >= self.limit:
+            _, connection = self.connections.popitem(last=False)
+            connection.close()
+            self.nr_evict += 1
 
         # check if parent directories exist
         if self.create_dir:
@@ -278,40 +419,72 @@ class MultiFileWriter:
 
         # open connection
         if self.compression == 'gzip':
-            self.paths[path]['connection'] = gzip.open(path, mode=mode)
+            connection = gzip.open(path, mode=mode)
         elif self.compression is None:
-            self.paths[path]['connection'] = open(path, mode=mode)
-        self.paths[path]['open'] = True
-
-        # increase count
+            connection = open(path, mode=mode)
+        self.connections[path] = connection
         self.nr_open += 1
 
+        return connection
+
+    def _connection(self, path):
+
+        connection = self.connections.get(path)
+        if connection is not None:
+            self.connections.move_to_end(path)
+            return connection
+
+        if path in self.opened:
+            # re-open connection (attach to file)
+            self.nr_reopen += 1
+            return self._open(path, self.append_mode)
+
+        self.opened.add(path)
+        return self._open(path, self.init_mode)
+
+    def flush(self, path=None):
+        """write buffer of path (all buffers if path is None)"""
+
+        paths = list(self.buffers.keys()) if path is None else [path]
+        for p in paths:
+            buffer = self.buffers.pop(p, None)
+            if not buffer:
+                continue
+            self._connection(p).write(buffer[0][:0].join(buffer))
+            self.nr_buffered -= self.buffer_lengths.pop(p)
+            self.nr_flush += 1
+
     def write(self, path, string):
 
         if path not in self.paths.keys():
+            self.paths[path] = 0
 
-            # init path
-            self.paths[path] = dict()
-            # open connection for first time
-            self._open(path, self.init_mode)
-            # start counting
-            self.paths[path]['count'] = 0
+        # buffer
+        buffer = self.buffers.get(path)
+        if buffer is None:
+            buffer = self.buffers[path] = list()
+            self.buffer_lengths[path] = 0
+        buffer.append(string)
+        self.buffer_lengths[path] += len(string)
+        self.nr_buffered += len(string)
 
-        elif not self.paths[path]['open']:
+        # count use
+        self.paths[path] += 1
 
-            # re-open connection (attach to file)
-            self._open(path, 'at')
+        # write in blocks
+        if self.buffer_lengths[path] >= self.buffer_size:
+            self.flush(path)
 
-        # write
-        self.paths[path]['connection'].write(string)
-        # count use
-        self.paths[path]['count'] += 1
+        elif self.nr_buffered > self.max_buffered:
+            for p in sorted(self.buffer_lengths, key=self.buffer_lengths.get, reverse=True):
+                self.flush(p)
+                if self.nr_buffered <= self.max_buffered // 2:
+                    break
 
     def close(self):
 
-        # close all paths
-        for path in self.paths.keys():
-            if 'connection' in self.paths[path].keys():
-                self.paths[path]['connection'].close()
-            self.paths[path]['open'] = False
-        self.nr_open = 0
+        # write all buffers and close all connections
+        self.flush()
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = OrderedDict()
@@ -1,12 +1,15 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import re
-import string
 import unicodedata
 import xml.etree.ElementTree as ET
+from functools import lru_cache
 from html import escape, unescape
 
+from vrt.stream import S_CLOSE, S_OPEN, iter_events
+
 
 def unescape_multiply_escaped(text, escape_chars={"&amp;", "&lt;", "&gt;", "&quot;", "&apos;"}):
     """unescapes (potentially) multiply XML-escaped string into normally escaped string.
@@ -38,51 +41,62 @@ def escape_xml_mysql(text):
     return text
 
 
-def force_categorical(text, fallback="NA"):
-    """converts strings to valid CQPweb categorical variables
+# some common German transliterations, common separators are replaced with underscores
+_TRANSLITERATION = str.maketrans({
+    "ä": "ae", "Ä": "AE", "ö": "oe", "Ö": "OE", "ü": "ue", "Ü": "UE", "ß": "ss",
+    " ": "_", "/": "_", "-": "_", "|": "_"
+})
+
+
+class _WhitelistTable(dict):
+    """translation table for str.translate: keeps (lowercased) characters
+    that are safe to use in CQPweb and deletes everything else
 
     """
+    def __missing__(self, codepoint):
+        self[codepoint] = None
+        return None
 
-    # these characters are safe to use in CQPweb
-    whitelist = set(
-        'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_0123456789'
-    )
 
-    # some common German transliterations
-    text = re.sub("ä", "ae", text)
-    text = re.sub("Ä", "AE", text)
-    text = re.sub("ö", "oe", text)
-    text = re.sub("Ö", "OE", text)
-    text = re.sub("ü", "ue", text)
-    text = re.sub("Ü", "UE", text)
-    text = re.sub("ß", "ss", text)
+_WHITELIST = _WhitelistTable(
+    {ord(c): ord(c.lower()) for c in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_0123456789'}
+)
+_LETTER = re.compile("[A-Za-z]")
+
+
+@lru_cache(maxsize=1 << 16)
+def force_categorical(text, fallback="NA"):
+    """converts strings to valid CQPweb categorical variables
+
+    memoised: see force_categorical.cache_info() for hit statistics
 
-    # replace common separators with underscores
-    text = re.sub(" ", "_", text)
-    text = re.sub("/", "_", text)
-    text = re.sub("-", "_", text)
-    text = re.sub(r"\|", "_", text)
+    """
 
-    # normalize (Asian spelling ...)
-    text = ''.join(x for x in unicodedata.normalize('NFKD', text) if x in string.printable).lower()
+    text = text.translate(_TRANSLITERATION)
 
-    # remove everything except whitelisted characters
-    handle = ''.join(filter(whitelist.__contains__, text))
+    # normalize (Asian spelling ...) and remove everything except whitelisted characters
+    handle = unicodedata.normalize('NFKD', text).translate(_WHITELIST)
 
     # use fallback for empty strings
     handle = fallback if handle == "" else handle
 
-    if not re.search("^[A-Za-z]", handle):
+    if not _LETTER.match(handle):
         handle = "c_" + handle
 
     return handle
 
 
-def meta2dict(line, level='text'):
-    """converts .vrt meta data line into dictionary
+# well-formed s-attribute line with double-quoted, whitespace-separated annotation;
+# everything else (single quotes, namespaces, control characters, ...) is left to ElementTree
+_XML_NAME = r'[A-Za-z_][-A-Za-z0-9_.]*'
+_XML_VALUE = r'"([^"<\x00-\x1f\ud800-\udfff\ufffe\uffff]*)"'
+_S_ATT_LINE = re.compile(rf'<({_XML_NAME})((?:[ \t\r\n]+(?![Xx][Mm][Ll]){_XML_NAME}[ \t\r\n]*=[ \t\r\n]*{_XML_VALUE})*)[ \t\r\n]*>[ \t\r\n]*\Z')
+
+
+def _meta2dict_etree(line, level='text'):
+    """converts .vrt meta data line into dictionary using ElementTree
 
     """
-    # TODO allow not passing level
     line = re.sub("&", "&amp;", line)  # allow ampersands in input
     tree = ET.fromstring(line + "</" + level + ">")  # close tag
 
@@ -94,6 +108,33 @@ def meta2dict(line, level='text'):
     return out
 
 
+@lru_cache(maxsize=4096)
+def _parse_s_att_line(line, level):
+    """parses s-attribute line into tuple of (key, value)-pairs
+
+    raises ET.ParseError for invalid lines (see _meta2dict_etree)
+    """
+
+    hit = _S_ATT_LINE.match(line)
+    if hit and hit.group(1) == level:
+        # values do not contain any quotes: split ' k1="v1" k2="v2"' into keys and values
+        fields = hit.group(2).split('"')
+        keys = [key.strip(" \t\r\n=") for key in fields[0:-1:2]]
+        values = [value.strip() for value in fields[1::2]]
+        if len(set(keys)) == len(keys):
+            return tuple(zip(keys, values))
+
+    return tuple(_meta2dict_etree(line, level).items())
+
+
+def meta2dict(line, level='text'):
+    """converts .vrt meta data line into dictionary
+
+    """
+    # TODO allow not passing level
+    return dict(_parse_s_att_line(line, level))
+
+
 def dict2meta(d, index_key='id', level='text'):
     """converts dictionary into .vrt meta data line
 
@@ -132,11 +173,28 @@ def remove_whitespace(txt):
     return txt
 
 
+class _EncodedReader:
+    """binary reads from a text file object (as needed by iter_events)"""
+
+    def __init__(self, f, encoding="utf-8"):
+        self.f = f
+        self.encoding = encoding
+
+    def read(self, size=-1):
+        return self.f.read(size).encode(self.encoding)
+
+
 def iter_s(f_in, level='text', yield_meta=True):
+    """iterate over regions of {level} in file object f_in (binary or text mode),
+    yield list of (stripped) lines (and meta data)
+
+    """
+    if isinstance(f_in, io.TextIOBase):
+        f_in = _EncodedReader(f_in)
     write = False
-    for line in f_in:
-        line = line.strip()
-        if line.startswith(f"<{level}>") or line.startswith(f"<{level} "):
+    for kind, name, line in iter_events(f_in):
+        if kind == S_OPEN and name == level:
+            line = line.decode().strip()
             try:
                 meta = meta2dict(line, level)
             except ET.ParseError:
@@ -145,11 +203,11 @@ def iter_s(f_in, level='text', yield_meta=True):
                 continue
             text = list()
             write = True
-        elif line.startswith(f"</{level}>"):
+        elif kind == S_CLOSE and name == level:
             if yield_meta:
                 yield text, meta
             else:
                 yield text
             write = False
         elif write:
-            text.append(line)
+            text.append(line.decode().strip())